@@ -1,40 +1,107 @@
 # Updated DbConnector.py
 from pymongo import MongoClient
+from pymongo.write_concern import WriteConcern
 import os
+import random
+import threading
 import time
 
+# One pooled client per process, shared by every DbConnector and closed with the last one
+_client = None
+_client_users = 0
+_client_lock = threading.Lock()
+
+
+def client_options() -> dict:
+    """
+    MongoClient settings from the environment: pool size and wire compression.
+    zstd and snappy need the zstandard and python-snappy packages, zlib is built in.
+    """
+    options = {
+        "serverSelectionTimeoutMS": int(os.getenv('MONGODB_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+        "connectTimeoutMS": 5000,
+        "maxPoolSize": int(os.getenv('MONGODB_MAX_POOL_SIZE', 100)),
+        "minPoolSize": int(os.getenv('MONGODB_MIN_POOL_SIZE', 0)),
+    }
+    compressors = os.getenv('MONGODB_COMPRESSORS')
+    if compressors:
+        options["compressors"] = compressors
+        if 'zlib' in compressors:
+            options["zlibCompressionLevel"] = int(os.getenv('MONGODB_ZLIB_LEVEL', -1))
+    return options
+
+
+def write_concern(phase: str) -> WriteConcern:
+    """
+    Write concern of a phase from MONGODB_<PHASE>_W and MONGODB_<PHASE>_J, e.g.
+    MONGODB_INGEST_W=1 for the bulk ingest. The ingest phase defaults to w=1 without
+    journaling, every other phase to w=majority.
+    """
+    default_w = '1' if phase == 'ingest' else 'majority'
+    w = os.getenv(f'MONGODB_{phase.upper()}_W', default_w)
+    j = os.getenv(f'MONGODB_{phase.upper()}_J')
+    return WriteConcern(
+        w=int(w) if w.isdigit() else w,
+        j=None if j is None else j.lower() in ('1', 'true')
+    )
+
+
+def backoff_delay(attempt: int, base: float = 0.25, cap: float = 8.0) -> float:
+    """
+    Exponential backoff with full jitter: a random delay up to base * 2^attempt, at most cap.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
 class DbConnector:
-    def __init__(self, max_retries=30, retry_delay=2):
+    def __init__(self, max_retries=30, retry_delay=0.25):
+        global _client, _client_users
         self.uri = os.getenv('MONGODB_URI', 'mongodb://mongodb:27017/')
         self.database = os.getenv('MONGODB_DATABASE', 'geolife')
-        
+
+        with _client_lock:
+            if _client is None:
+                _client = self.connect(max_retries, retry_delay)
+            _client_users += 1
+        self.client = _client
+        self.db = self.get_database()
+
+    def connect(self, max_retries: int, retry_delay: float) -> MongoClient:
         print(f"Attempting to connect to MongoDB at {self.uri}")
-        retry_count = 0
+        # The client reconnects by itself, so it is built once and only the ping is retried
+        client = MongoClient(self.uri, **client_options())
         last_error = None
-        
-        while retry_count < max_retries:
+
+        for attempt in range(max_retries):
             try:
-                self.client = MongoClient(
-                    self.uri,
-                    serverSelectionTimeoutMS=5000,
-                    connectTimeoutMS=5000,
-                )
-                # Test the connection
-                self.client.server_info()
-                self.db = self.client[self.database]
-                print(f"Successfully connected to MongoDB database: {self.db.name}")
-                return
+                client.admin.command('ping')
+                print(f"Successfully connected to MongoDB database: {self.database}")
+                return client
             except Exception as e:
                 last_error = e
-                retry_count += 1
-                print(f"Connection attempt {retry_count}/{max_retries} failed: {e}")
-                if retry_count < max_retries:
-                    print(f"Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
-        
+                print(f"Connection attempt {attempt + 1}/{max_retries} failed: {e}")
+                if attempt + 1 < max_retries:
+                    delay = backoff_delay(attempt, retry_delay)
+                    print(f"Retrying in {delay:.2f} seconds...")
+                    time.sleep(delay)
+
+        client.close()
         raise Exception(f"Failed to connect to MongoDB after {max_retries} attempts. Last error: {last_error}")
 
+    def get_database(self, phase: str = 'default'):
+        """
+        The database with the write concern of phase, see write_concern.
+        """
+        return self.client.get_database(self.database, write_concern=write_concern(phase))
+
     def close_connection(self):
-        if hasattr(self, 'client'):
-            self.client.close()
-            print(f"Connection to {self.db.name}-db is closed")
\ No newline at end of file
+        global _client, _client_users
+        if not hasattr(self, 'client'):
+            return
+        with _client_lock:
+            _client_users -= 1
+            if _client_users == 0 and _client is self.client:
+                _client.close()
+                _client = None
+                print(f"Connection to {self.db.name}-db is closed")
+        del self.client
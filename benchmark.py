@@ -0,0 +1,165 @@
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+from contextlib import redirect_stdout
+from typing import Dict, List
+
+from pymongo import monitoring
+
+from generate_dataset import generate_dataset
+from query_stats import QueryStatsListener
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+def timed(results: Dict, name: str, func, *args, **kwargs):
+    start = time.perf_counter()
+    value = func(*args, **kwargs)
+    results[name] = round(time.perf_counter() - start, 4)
+    return value
+
+
+def benchmark_ingest(dataset_path: str, workers: int, batch_size: int, trackpoint_format: str,
+                     writers: int = 0) -> Dict:
+    """
+    Run a full ingest like main.py does and time each phase.
+    """
+    from main import ActivityTrackerProgram
+
+    phases = {}
+    program = ActivityTrackerProgram(batch_size=batch_size, trackpoint_format=trackpoint_format)
+    try:
+        timed(phases, 'drop_and_create', lambda: (program.drop_collections(), program.create_collections()))
+        program.set_write_phase('ingest')
+        timed(phases, 'populate_users', program.populate_user_table, dataset_path)
+        timed(phases, 'populate_activities', program.populate_activities, dataset_path, workers=workers,
+              writers=writers)
+        program.set_write_phase('default')
+        timed(phases, 'update_transportation_modes', program.update_transportation_modes, dataset_path)
+        timed(phases, 'verify_transportation_modes', program.verify_transportation_modes, dataset_path)
+        phases['total'] = round(sum(phases.values()), 4)
+        phases['activities'] = program.db.activities.estimated_document_count()
+    finally:
+        program.connection.close_connection()
+    return phases
+
+
+def benchmark_queries(stats_listener: QueryStatsListener, repeat: int) -> Dict:
+    """
+    Time every part2 query, uncached, repeat times. Keeps the fastest run of each,
+    together with the documents and bytes it returned.
+    """
+    from part2 import ActivityTrackerProgram, QUERIES
+
+    queries = {}
+    program = ActivityTrackerProgram(use_cache=False)
+    try:
+        for query_id, compute_name, _ in QUERIES:
+            runs = []
+            for _ in range(repeat):
+                _, error, metrics = program.run_timed_query(query_id, compute_name, stats_listener)
+                metrics.pop('explainable', None)
+                if error is not None:
+                    metrics['error'] = str(error)
+                runs.append(metrics)
+            best = min(runs, key=lambda m: m['seconds'])
+            best['all_seconds'] = [m['seconds'] for m in runs]
+            queries[query_id] = best
+    finally:
+        program.connection.close_connection()
+    return queries
+
+
+def compare(results: Dict, baseline: Dict, max_regression: float) -> List[str]:
+    """
+    Names of the ingest phases and queries that got more than max_regression times
+    slower than in the baseline results.
+    """
+    regressions = []
+    timings = [('ingest', name, seconds) for name, seconds in results['ingest'].items() if name != 'activities']
+    timings += [('query', name, metrics['seconds']) for name, metrics in results['queries'].items()]
+    for kind, name, seconds in timings:
+        if kind == 'ingest':
+            before = baseline.get('ingest', {}).get(name)
+        else:
+            before = baseline.get('queries', {}).get(name, {}).get('seconds')
+        # Ignore timings too small to compare reliably
+        if before and seconds > before * max_regression and seconds - before > 0.01:
+            regressions.append(f"{kind} {name}: {before}s -> {seconds}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingest and the part2 queries against a local mongod")
+    parser.add_argument('--dataset', default='bench_data',
+                        help="directory holding (or to generate) the dataset/ tree")
+    parser.add_argument('--generate', action='store_true', help="generate a synthetic dataset first")
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--activities-per-user', type=int, default=20)
+    parser.add_argument('--points-per-activity', type=int, default=500)
+    parser.add_argument('--oversized-per-user', type=int, default=1)
+    parser.add_argument('--database', default='geolife_bench',
+                        help="database to use, it is dropped and refilled")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--writers', type=int, default=2, help="bulk writer threads, 0 writes inline")
+    parser.add_argument('--trackpoint-format', default='array', choices=['array', 'columnar', 'bucketed'])
+    parser.add_argument('--repeat', type=int, default=3, help="runs per query")
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--max-regression', type=float, default=1.2,
+                        help="slowdown factor against the baseline that counts as a regression")
+    args = parser.parse_args()
+
+    # DbConnector reads the database name from the environment
+    os.environ['MONGODB_DATABASE'] = args.database
+    stats_listener = QueryStatsListener()
+    monitoring.register(stats_listener)
+
+    if args.generate:
+        generate_dataset(args.dataset, users=args.users, activities_per_user=args.activities_per_user,
+                         points_per_activity=args.points_per_activity,
+                         oversized_per_user=args.oversized_per_user)
+
+    # Keep the programs' own output away from the JSON results
+    with redirect_stdout(sys.stderr):
+        ingest = benchmark_ingest(args.dataset, args.workers, args.batch_size, args.trackpoint_format,
+                                  args.writers)
+        queries = benchmark_queries(stats_listener, args.repeat)
+
+    results = {
+        "timestamp": datetime.datetime.utcnow().isoformat(),
+        "git_commit": git_commit(),
+        "config": vars(args),
+        "ingest": ingest,
+        "queries": queries
+    }
+
+    output = json.dumps(results, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import os
+from typing import Dict
+
+
+def scan_dataset(dataset_path: str, verbose: bool = True) -> Dict:
+    """
+    Catalog dataset/Data in one os.scandir pass: every user directory, the location of
+    its labels.txt if there is one, and every .plt file in its Trajectory directory with
+    size and mtime. Returns
+    {"data_path", "users": {user_id: {"labels_file", "trajectory_path"}},
+     "trajectory_files": {path relative to data_path: {user_id, activity_id, root, file, size, mtime}}}.
+    """
+    data_path = os.path.join(dataset_path, 'dataset', 'Data')
+    users = {}
+    trajectory_files = {}
+
+    with os.scandir(data_path) as user_entries:
+        for user_entry in sorted(user_entries, key=lambda entry: entry.name):
+            if not user_entry.is_dir():
+                continue
+            user_id = user_entry.name
+            user = users[user_id] = {"labels_file": None, "trajectory_path": None}
+            with os.scandir(user_entry.path) as entries:
+                for entry in entries:
+                    if entry.name == 'labels.txt' and entry.is_file():
+                        user["labels_file"] = entry.path
+                    elif entry.name == 'Trajectory' and entry.is_dir():
+                        user["trajectory_path"] = entry.path
+            if user["trajectory_path"]:
+                trajectory_files.update(scan_trajectory_files(user_id, user["trajectory_path"], data_path, verbose))
+
+    return {"data_path": data_path, "users": users, "trajectory_files": trajectory_files}
+
+
+def scan_trajectory_files(user_id: str, trajectory_path: str, data_path: str,
+                          verbose: bool = True) -> Dict[str, Dict]:
+    """
+    The .plt files of one user, keyed by their path relative to data_path.
+    """
+    trajectory_files = {}
+    with os.scandir(trajectory_path) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.plt') or not entry.is_file():
+                continue
+            activity_id_str = f"{user_id}{os.path.splitext(entry.name)[0]}"
+            try:
+                activity_id = int(activity_id_str)
+            except ValueError:
+                if verbose:
+                    print(f"Invalid activity_id generated: {activity_id_str}")
+                continue
+            stat = entry.stat()
+            trajectory_files[os.path.relpath(entry.path, data_path)] = {
+                "user_id": user_id,
+                "activity_id": activity_id,
+                "root": trajectory_path,
+                "file": entry.name,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime
+            }
+    return trajectory_files
@@ -0,0 +1,127 @@
+import argparse
+import datetime
+import os
+import random
+
+from plt_reader import MAX_TRACKPOINTS
+
+PLT_HEADER = [
+    'Geolife trajectory',
+    'WGS 84',
+    'Altitude is in Feet',
+    'Reserved 3',
+    '0,2,255,My Track,0,0,2,8421376',
+    '0'
+]
+MODES = ['walk', 'bus', 'car', 'taxi', 'subway', 'train', 'bike']
+# Day zero of the date_days column in .plt files
+DATE_DAYS_EPOCH = datetime.datetime(1899, 12, 30)
+# The Forbidden City, so query 10 has something to find
+FORBIDDEN_CITY = (39.916, 116.397)
+
+
+def write_plt_file(path: str, start: datetime.datetime, points: int, rng: random.Random) -> datetime.datetime:
+    """
+    Write a random walk around Beijing with the given number of trackpoints.
+    Returns the timestamp of the last trackpoint.
+    """
+    if rng.random() < 0.1:
+        lat, lon = FORBIDDEN_CITY
+    else:
+        lat, lon = 39.9 + rng.uniform(-0.3, 0.3), 116.4 + rng.uniform(-0.3, 0.3)
+    altitude = rng.randint(0, 300)
+    timestamp = start
+
+    lines = list(PLT_HEADER)
+    for i in range(points):
+        if i:
+            # Now and then a gap of several minutes, which makes the activity invalid in query 9
+            timestamp += datetime.timedelta(seconds=rng.choice([1, 2, 5, 5, 5, 10]) if rng.random() > 0.002 else 600)
+            lat += rng.uniform(-0.0002, 0.0002)
+            lon += rng.uniform(-0.0002, 0.0002)
+            altitude = max(altitude + rng.randint(-5, 5), 0)
+        date_days = (timestamp - DATE_DAYS_EPOCH).total_seconds() / 86400
+        shown_altitude = -777 if rng.random() < 0.05 else altitude
+        lines.append(f"{lat:.6f},{lon:.6f},0,{shown_altitude},{date_days:.10f},"
+                     f"{timestamp:%Y-%m-%d},{timestamp:%H:%M:%S}")
+
+    with open(path, 'w', newline='') as f:
+        f.write('\r\n'.join(lines) + '\r\n')
+    return timestamp
+
+
+def generate_dataset(output_path: str, users: int = 20, activities_per_user: int = 20,
+                     points_per_activity: int = 500, oversized_per_user: int = 1,
+                     labeled_fraction: float = 0.5, seed: int = 0):
+    """
+    Write a Geolife-shaped tree under output_path/dataset: labeled_ids.txt and
+    Data/<user>/Trajectory/*.plt, plus labels.txt for the labeled users. Labels
+    match some activities exactly and cover random other intervals otherwise.
+    Points per activity vary by up to 50% around points_per_activity, and every
+    user gets oversized_per_user files above the trackpoint cap.
+    """
+    rng = random.Random(seed)
+    data_path = os.path.join(output_path, 'dataset', 'Data')
+    user_ids = [f"{i:03d}" for i in range(users)]
+    labeled_ids = [user_id for user_id in user_ids if rng.random() < labeled_fraction]
+
+    os.makedirs(data_path, exist_ok=True)
+    with open(os.path.join(output_path, 'dataset', 'labeled_ids.txt'), 'w') as f:
+        f.write('\n'.join(labeled_ids) + '\n')
+
+    for user_id in user_ids:
+        trajectory_path = os.path.join(data_path, user_id, 'Trajectory')
+        os.makedirs(trajectory_path, exist_ok=True)
+        start = datetime.datetime(2007, 4, 1) + datetime.timedelta(days=rng.randint(0, 1500))
+        labels = []
+
+        for i in range(activities_per_user + oversized_per_user):
+            if i < activities_per_user:
+                points = max(2, min(MAX_TRACKPOINTS, int(points_per_activity * rng.uniform(0.5, 1.5))))
+            else:
+                points = MAX_TRACKPOINTS + rng.randint(1, 500)
+            file_path = os.path.join(trajectory_path, f"{start:%Y%m%d%H%M%S}.plt")
+            end = write_plt_file(file_path, start, points, rng)
+
+            if user_id in labeled_ids and rng.random() < 0.7:
+                labels.append((start, end, rng.choice(MODES)))
+            start = end + datetime.timedelta(hours=rng.randint(1, 72))
+
+        if user_id in labeled_ids:
+            # Labels that do not match any activity, like most of the real ones
+            for _ in range(activities_per_user // 4):
+                label_start = start + datetime.timedelta(hours=rng.randint(1, 1000))
+                labels.append((label_start, label_start + datetime.timedelta(minutes=30), rng.choice(MODES)))
+            with open(os.path.join(data_path, user_id, 'labels.txt'), 'w') as f:
+                f.write('Start Time\tEnd Time\tTransportation Mode\n')
+                for label_start, label_end, mode in sorted(labels):
+                    f.write(f"{label_start:%Y/%m/%d %H:%M:%S}\t{label_end:%Y/%m/%d %H:%M:%S}\t{mode}\n")
+
+    print(f"Generated {users} users ({len(labeled_ids)} labeled) with "
+          f"{activities_per_user + oversized_per_user} trajectory files each in {data_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Geolife dataset")
+    parser.add_argument('output', help="directory to create the dataset/ tree in")
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--activities-per-user', type=int, default=20)
+    parser.add_argument('--points-per-activity', type=int, default=500)
+    parser.add_argument('--oversized-per-user', type=int, default=1)
+    parser.add_argument('--labeled-fraction', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate_dataset(
+        args.output,
+        users=args.users,
+        activities_per_user=args.activities_per_user,
+        points_per_activity=args.points_per_activity,
+        oversized_per_user=args.oversized_per_user,
+        labeled_fraction=args.labeled_fraction,
+        seed=args.seed
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,395 @@
+import argparse
+import datetime
+import os
+import socket
+import threading
+import time
+from typing import Dict
+
+from pymongo import ASCENDING, ReturnDocument
+from tabulate import tabulate
+
+from instrumentation import Metrics
+from main import ActivityTrackerProgram, parse_user_trajectories, program_from_env, update_labels_from_env
+from report_cache import bump_data_generation
+
+# Every job of one distributed ingest. A job ingests a set of .plt files of one user, the
+# single finalize job sets the transportation modes once no ingest job is queued or running
+JOBS_COLLECTION = 'ingest_jobs'
+FINALIZE_JOB_ID = 'finalize'
+
+
+# Leases are set and compared with the clock of the server ($$NOW), never that of a
+# worker, so workers on hosts whose clocks disagree still agree on which leases expired
+LEASE_EXPIRED = {"$expr": {"$lt": ["$lease_expires", "$$NOW"]}}
+LEASE_VALID = {"$expr": {"$gt": ["$lease_expires", "$$NOW"]}}
+
+
+def lease_expiry(lease_seconds: float) -> Dict:
+    return {"$add": ["$$NOW", int(lease_seconds * 1000)]}
+
+
+def server_now(db) -> datetime.datetime:
+    return db.command('hello')['localTime'].replace(tzinfo=None)
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def enqueue_jobs(program: ActivityTrackerProgram, dataset_path: str, incremental: bool = False,
+                 files_per_job: int = None) -> int:
+    """
+    Prepare the collections like main.py does (dropping them unless incremental), insert
+    the users, and replace the jobs collection with one ingest job per user, or per
+    files_per_job files of a user, for every .plt file the manifest says needs ingesting,
+    plus the finalize job. Returns the number of ingest jobs.
+    """
+    bump_data_generation(program.db)
+    if not incremental:
+        program.drop_collections()
+    program.create_collections()
+    jobs = program.db[JOBS_COLLECTION]
+    jobs.drop()
+    jobs.create_index([("kind", ASCENDING), ("state", ASCENDING), ("lease_expires", ASCENDING)])
+
+    program.set_write_phase('ingest')
+    program.populate_user_table(dataset_path, incremental=incremental)
+    pending = program.plan_manifest(program.get_catalog(dataset_path)['trajectory_files'], incremental)
+    program.set_write_phase('default')
+    program.metrics.incr('files', len(pending))
+    program.metrics.incr('bytes', sum(entry['size'] for entry in pending.values()))
+
+    user_entries = {}
+    for entry in pending.values():
+        user_entries.setdefault(entry['user_id'], []).append(entry)
+
+    now = server_now(program.db)
+    docs = []
+    for user_id in sorted(user_entries):
+        entries = sorted(user_entries[user_id], key=lambda entry: entry['file'])
+        size = files_per_job or len(entries)
+        for part, start in enumerate(range(0, len(entries), size)):
+            batch = entries[start:start + size]
+            docs.append({
+                "_id": f"{user_id}:{part}",
+                "kind": "ingest",
+                "user_id": user_id,
+                "root": batch[0]['root'],
+                "files": [entry['file'] for entry in batch],
+                "activity_ids": [entry['activity_id'] for entry in batch],
+                "file_count": len(batch),
+                "state": "queued",
+                "attempts": 0,
+                "created_at": now
+            })
+    docs.append({"_id": FINALIZE_JOB_ID, "kind": "finalize", "state": "queued", "attempts": 0, "created_at": now})
+    for start in range(0, len(docs), program.batch_size):
+        jobs.insert_many(docs[start:start + program.batch_size])
+    print(f"Enqueued {len(docs) - 1} ingest jobs for {len(pending)} trajectory files")
+    return len(docs) - 1
+
+
+def retry_failed_jobs(jobs) -> int:
+    """
+    Queue the failed jobs again with a fresh attempt count, and the finalize job too
+    if it already ran, so the labels are updated after them.
+    """
+    result = jobs.update_many({"state": "failed"}, {"$set": {"state": "queued", "attempts": 0}})
+    if result.modified_count:
+        jobs.update_one({"_id": FINALIZE_JOB_ID}, {"$set": {"state": "queued", "attempts": 0}})
+    return result.modified_count
+
+
+def claim_job(jobs, worker: str, kind: str, lease_seconds: float, max_attempts: int) -> Dict:
+    """
+    Atomically take the first queued job of this kind, or one whose lease expired
+    because its worker died, and lease it to worker for lease_seconds. attempts is
+    incremented on every claim, so (_id, worker, attempts) identifies this claim; see
+    holds_lease for how a worker that lost its lease is stopped.
+    """
+    return jobs.find_one_and_update(
+        {
+            "kind": kind,
+            "attempts": {"$lt": max_attempts},
+            "$or": [{"state": "queued"}, {"state": "running", **LEASE_EXPIRED}]
+        },
+        [{"$set": {
+            "state": "running",
+            "worker": {"$literal": worker},
+            "started_at": "$$NOW",
+            "lease_expires": lease_expiry(lease_seconds),
+            "attempts": {"$add": ["$attempts", 1]}
+        }}],
+        sort=[("_id", ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+def fail_exhausted_jobs(jobs, max_attempts: int):
+    jobs.update_many(
+        {"state": "running", "attempts": {"$gte": max_attempts}, **LEASE_EXPIRED},
+        {"$set": {"state": "failed", "error": f"lease expired {max_attempts} times"}}
+    )
+
+
+def finish_job(jobs, job: Dict, update: Dict) -> bool:
+    """
+    Record the outcome of a claimed job, unless its lease was taken over meanwhile.
+    """
+    result = jobs.update_one(
+        {"_id": job["_id"], "worker": job["worker"], "attempts": job["attempts"]},
+        [{"$set": {
+            **{key: {"$literal": value} for key, value in update.items()},
+            "finished_at": "$$NOW",
+            "lease_expires": "$$REMOVE"
+        }}]
+    )
+    return result.modified_count == 1
+
+
+def holds_lease(jobs, job: Dict) -> bool:
+    return jobs.count_documents({
+        "_id": job["_id"], "worker": job["worker"], "attempts": job["attempts"],
+        "state": "running", **LEASE_VALID
+    }) > 0
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class FencedWriter:
+    """
+    Takes the place of ActivityTrackerProgram.writer while a job runs, and checks that
+    the job's lease is still held, and not about to be taken over, before each batch is
+    written. A worker that lost its lease stops with LeaseLost at its next batch instead
+    of racing the new owner, which deletes and rewrites the same activities. The check
+    and the write are not atomic, so at most the batch in flight can still overlap.
+    """
+
+    def __init__(self, program: ActivityTrackerProgram, jobs, job: Dict, lease: 'LeaseKeeper'):
+        self.program = program
+        self.jobs = jobs
+        self.job = job
+        self.lease = lease
+
+    def check(self):
+        if self.lease.lost or not holds_lease(self.jobs, self.job):
+            self.lease.lost = True
+            raise LeaseLost(f"job {self.job['_id']} lost its lease")
+
+    def submit(self, docs, buckets):
+        self.check()
+        self.program.write_activities(docs, buckets)
+
+
+class LeaseKeeper:
+    """
+    Extends the lease of a running job every third of lease_seconds from a background
+    thread, so long jobs are not taken over while their worker is alive.
+    """
+
+    def __init__(self, jobs, job: Dict, lease_seconds: float):
+        self.jobs = jobs
+        self.job = job
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            result = self.jobs.update_one(
+                {"_id": self.job["_id"], "worker": self.job["worker"], "attempts": self.job["attempts"]},
+                [{"$set": {"lease_expires": lease_expiry(self.lease_seconds)}}]
+            )
+            if result.matched_count == 0:
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stopped.set()
+        self.thread.join()
+        return False
+
+
+def run_ingest_job(program: ActivityTrackerProgram, job: Dict, fence: FencedWriter,
+                   parser: str = 'numpy') -> Dict:
+    """
+    Parse and write the files of one job, checking the lease with fence before every
+    write. Activities a previous attempt may have left behind are deleted first, so a
+    retried job starts from a clean slate.
+    """
+    fence.check()
+    program.delete_activities(job['activity_ids'])
+    errors_before = len(program.batch_errors)
+    user_id, parsed = parse_user_trajectories(job['user_id'], job['root'], job['files'],
+                                              program.metrics.verbose, parser, program.max_trackpoints)
+    program.set_write_phase('ingest')
+    program.writer = fence
+    try:
+        fence.check()
+        program.insert_parsed_activities(user_id, parsed, True, job['files'])
+        program.flush_activities()
+    finally:
+        # Nothing of a failed attempt may end up in the batches of the next job
+        program.pending_activities, program.pending_buckets = [], []
+        program.writer = None
+        program.set_write_phase('default')
+    return {
+        "files": len(job['files']),
+        "activities": len(parsed),
+        "trackpoints": sum(len(trackpoints) for _, _, trackpoints in parsed),
+        "errors": sum(len(batch['errors']) for batch in program.batch_errors[errors_before:])
+    }
+
+
+def run_job(program: ActivityTrackerProgram, job: Dict, dataset_path: str, lease_seconds: float,
+            max_attempts: int, parser: str):
+    jobs = program.db[JOBS_COLLECTION]
+    print(f"{job['worker']} running job {job['_id']} (attempt {job['attempts']})")
+    start = time.perf_counter()
+    lease = LeaseKeeper(jobs, job, lease_seconds)
+    result = None
+    try:
+        with lease:
+            if job['kind'] == 'finalize':
+                update_labels_from_env(program, dataset_path, program.metrics)
+                bump_data_generation(program.db)
+                result = {}
+            else:
+                result = run_ingest_job(program, job, FencedWriter(program, jobs, job, lease), parser)
+        update = {"state": "done", "result": result}
+    except LeaseLost:
+        update = {"state": "lost"}
+    except Exception as e:
+        program.metrics.incr('errors')
+        print(f"ERROR: job {job['_id']} failed: {e}")
+        update = {"state": "failed" if job['attempts'] >= max_attempts else "queued", "error": str(e)}
+
+    seconds = time.perf_counter() - start
+    if lease.lost or not finish_job(jobs, job, update):
+        print(f"Job {job['_id']} lost its lease to another worker, its result was discarded")
+    program.metrics.emit({"event": "job", "job": job['_id'], "attempt": job['attempts'],
+                          "state": update['state'], "seconds": round(seconds, 6), **(result or {})})
+
+
+def work(program: ActivityTrackerProgram, dataset_path: str, lease_seconds: float = 300,
+         max_attempts: int = 3, poll_interval: float = 5, parser: str = 'numpy',
+         finalize: bool = True, worker: str = None) -> int:
+    """
+    Claim and run jobs until none is left. While other workers still hold ingest jobs,
+    wait for them, as their leases may expire and need retrying. Once no ingest job is
+    queued or running, one worker runs the finalize job, unless finalize is off.
+    Returns the number of jobs this worker ran.
+    """
+    jobs = program.db[JOBS_COLLECTION]
+    worker = worker or worker_name()
+    ran = 0
+    while True:
+        fail_exhausted_jobs(jobs, max_attempts)
+        job = claim_job(jobs, worker, 'ingest', lease_seconds, max_attempts)
+        if job is None and not jobs.count_documents({"kind": "ingest", "state": {"$in": ["queued", "running"]}}):
+            if not finalize:
+                break
+            job = claim_job(jobs, worker, 'finalize', lease_seconds, max_attempts)
+            if job is None and jobs.count_documents({"_id": FINALIZE_JOB_ID, "state": {"$in": ["done", "failed"]}}):
+                break
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        run_job(program, job, dataset_path, lease_seconds, max_attempts, parser)
+        ran += 1
+    print(f"{worker} ran {ran} jobs, no jobs left")
+    return ran
+
+
+def job_status(jobs) -> Dict:
+    """
+    Progress of the ingest jobs: jobs and files per state, the totals of the finished
+    jobs, and the running and failed jobs.
+    """
+    status = {"states": {}, "files": {}, "totals": {"activities": 0, "trackpoints": 0, "errors": 0},
+              "running": [], "failed": [], "finalize": None}
+    now = server_now(jobs.database)
+    for job in jobs.find({}, {"files": 0, "activity_ids": 0}).sort("_id", ASCENDING):
+        if job['kind'] == 'finalize':
+            status['finalize'] = job['state']
+            continue
+        state = job['state']
+        status['states'][state] = status['states'].get(state, 0) + 1
+        status['files'][state] = status['files'].get(state, 0) + job['file_count']
+        for key in status['totals']:
+            status['totals'][key] += (job.get('result') or {}).get(key, 0)
+        if state == 'running':
+            status['running'].append({
+                "job": job['_id'], "worker": job['worker'], "attempt": job['attempts'],
+                "lease_left_seconds": round((job['lease_expires'] - now).total_seconds())
+            })
+        elif state == 'failed':
+            status['failed'].append({"job": job['_id'], "attempts": job['attempts'], "error": job.get('error')})
+    return status
+
+
+def print_status(status: Dict):
+    jobs_total = sum(status['states'].values())
+    files_total = sum(status['files'].values())
+    print(f"{status['states'].get('done', 0)} of {jobs_total} ingest jobs done, "
+          f"{status['files'].get('done', 0)} of {files_total} files; finalize: {status['finalize']}")
+    print(tabulate([[state, count, status['files'][state]] for state, count in sorted(status['states'].items())],
+                   headers=['state', 'jobs', 'files'], tablefmt='grid'))
+    print(f"Ingested {status['totals']['activities']} activities and {status['totals']['trackpoints']} "
+          f"trackpoints with {status['totals']['errors']} write errors")
+    if status['running']:
+        print(tabulate(status['running'], headers='keys', tablefmt='grid'))
+    if status['failed']:
+        print(tabulate(status['failed'], headers='keys', tablefmt='grid'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distributed ingest through a jobs collection in MongoDB")
+    commands = parser.add_subparsers(dest='command', required=True)
+    enqueue = commands.add_parser('enqueue', help="prepare the collections and enqueue the ingest jobs")
+    enqueue.add_argument('--incremental', action='store_true',
+                         help="keep the data and only enqueue new, changed or unfinished files")
+    enqueue.add_argument('--files-per-job', type=int, help="split users into jobs of this many files")
+    worker = commands.add_parser('work', help="claim and run jobs until none is left")
+    worker.add_argument('--lease-seconds', type=float, default=300)
+    worker.add_argument('--max-attempts', type=int, default=3)
+    worker.add_argument('--poll-interval', type=float, default=5)
+    worker.add_argument('--no-finalize', action='store_true', help="leave the label update to another worker")
+    commands.add_parser('status', help="print the progress of the jobs")
+    commands.add_parser('retry-failed', help="queue the failed jobs again")
+    parser.add_argument('--dataset', default='dataset')
+    args = parser.parse_args()
+
+    metrics = Metrics.from_env()
+    program = program_from_env(metrics)
+    try:
+        jobs = program.db[JOBS_COLLECTION]
+        if args.command == 'enqueue':
+            with metrics.phase('enqueue'):
+                enqueue_jobs(program, args.dataset, args.incremental, args.files_per_job)
+        elif args.command == 'work':
+            with metrics.phase('work'):
+                work(program, args.dataset, args.lease_seconds, args.max_attempts, args.poll_interval,
+                     os.getenv('PLT_PARSER', 'numpy'), not args.no_finalize)
+            program.print_batch_errors(program.batch_errors)
+        elif args.command == 'status':
+            print_status(job_status(jobs))
+        elif args.command == 'retry-failed':
+            print(f"Queued {retry_failed_jobs(jobs)} failed jobs again")
+    finally:
+        if args.command in ('enqueue', 'work'):
+            metrics.summary()
+        metrics.close()
+        program.connection.close_connection()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, Dict, Iterator, List, Tuple
+
+# Tells a writer thread to stop
+_STOP = object()
+
+
+class BulkWriterPool:
+    """
+    Runs a write function on writers threads, fed from a queue of at most max_pending
+    batches. submit blocks while the queue is full, which slows the producing stages
+    down to the pace of the server instead of buffering without bound. The first
+    exception raised by a write stops the pool and is re-raised by the next submit
+    or by close. Use it as a context manager: leaving the block waits for all queued
+    batches, unless it is left with an exception, in which case they are dropped.
+    """
+
+    def __init__(self, write: Callable, writers: int = 2, max_pending: int = None):
+        self.write = write
+        self.queue = queue.Queue(maxsize=max_pending or writers * 2)
+        self.error = None
+        self.failed = threading.Event()
+        self.closed = False
+        self.threads = [threading.Thread(target=self.run, name=f"bulk-writer-{i}", daemon=True)
+                        for i in range(writers)]
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is _STOP:
+                    return
+                if not self.failed.is_set():
+                    self.write(*item)
+            except BaseException as e:
+                if not self.failed.is_set():
+                    self.error = e
+                    self.failed.set()
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        if self.failed.is_set():
+            raise RuntimeError(f"Bulk write failed: {self.error}") from self.error
+
+    def submit(self, *args):
+        self.raise_error()
+        # Wait in short steps, so a failure in a writer is noticed while blocked
+        while True:
+            try:
+                self.queue.put(args, timeout=0.5)
+                return
+            except queue.Full:
+                self.raise_error()
+
+    def close(self, drop_pending: bool = False):
+        if self.closed:
+            return
+        self.closed = True
+        if drop_pending:
+            self.failed.set()
+        for _ in self.threads:
+            self.queue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        if not drop_pending:
+            self.raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(drop_pending=exc_type is not None)
+        return False
+
+
+def iter_parsed(parse: Callable, shards: Dict[str, Tuple], workers: int,
+                max_in_flight: int = None) -> Iterator[Tuple[str, List[tuple], Tuple]]:
+    """
+    Yields (shard key, parse result, shard) as the shards are parsed, with parse(key, *shard)
+    run on a pool of workers processes if workers > 1. At most max_in_flight shards are
+    submitted at a time, so parsing does not run ahead of the stages consuming the results.
+    """
+    if workers <= 1:
+        for key, shard in shards.items():
+            yield key, parse(key, *shard), shard
+        return
+
+    max_in_flight = max_in_flight or workers * 2
+    pending_shards = iter(shards.items())
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = {}
+        try:
+            while True:
+                for key, shard in pending_shards:
+                    in_flight[executor.submit(parse, key, *shard)] = (key, shard)
+                    if len(in_flight) >= max_in_flight:
+                        break
+                if not in_flight:
+                    return
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, shard = in_flight.pop(future)
+                    yield key, future.result(), shard
+        finally:
+            for future in in_flight:
+                future.cancel()
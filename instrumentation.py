@@ -0,0 +1,97 @@
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+
+class Metrics:
+    """
+    Phase timers, counters and throughput rates for the ingest and report programs.
+    Every finished phase and the final summary are written as one JSON object per line
+    to path ('-' for stdout); without a path nothing is written. With verbose off,
+    the per-line progress messages passed to log() are dropped.
+    """
+
+    def __init__(self, path: str = None, verbose: bool = True):
+        self.verbose = verbose
+        self.counters = {}
+        self.phases = {}
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.stream = None
+        if path == '-':
+            self.stream = sys.stdout
+        elif path:
+            self.stream = open(path, 'a')
+
+    @classmethod
+    def from_env(cls) -> 'Metrics':
+        return cls(os.getenv('METRICS_PATH'), verbose=os.getenv('LOG_VERBOSE', '1') != '0')
+
+    def log(self, message: str):
+        if self.verbose:
+            print(message)
+
+    def incr(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @staticmethod
+    def rates(counters: Dict, seconds: float) -> Dict:
+        if seconds <= 0:
+            return {}
+        return {f"{name}_per_second": round(value / seconds, 2) for name, value in counters.items()}
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Time the block and emit the counters it changed, with their rates.
+        """
+        with self.lock:
+            before = dict(self.counters)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                changed = {key: value - before.get(key, 0) for key, value in self.counters.items()
+                           if value != before.get(key, 0)}
+                self.phases[name] = self.phases.get(name, 0) + seconds
+            self.emit({
+                "event": "phase",
+                "phase": name,
+                "seconds": round(seconds, 4),
+                "counters": changed,
+                "rates": self.rates(changed, seconds)
+            })
+
+    def emit(self, record: Dict):
+        if self.stream is None:
+            return
+        line = json.dumps({"time": datetime.datetime.utcnow().isoformat(), **record}, default=str)
+        with self.lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+    def summary(self):
+        seconds = time.perf_counter() - self.started
+        with self.lock:
+            counters = dict(self.counters)
+            phases = {name: round(value, 4) for name, value in self.phases.items()}
+        self.emit({
+            "event": "summary",
+            "seconds": round(seconds, 4),
+            "phases": phases,
+            "counters": counters,
+            "rates": self.rates(counters, seconds)
+        })
+
+    def close(self):
+        if self.stream is not None and self.stream is not sys.stdout:
+            self.stream.close()
+        self.stream = None
@@ -0,0 +1,148 @@
+import bisect
+import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+
+class LabelIndex:
+    """
+    The labels of one user sorted by start time, with a segment tree holding the
+    maximum end time of every range of them. The labels overlapping an interval are
+    the ones starting before its end (one bisect) whose end is not before its start,
+    found by descending only into subtrees whose maximum end reaches the interval:
+    O((1 + overlapping labels) * log labels) per lookup, however long some labels are.
+    """
+
+    def __init__(self, labels: List[Tuple[datetime.datetime, datetime.datetime, str]]):
+        # Sorting is stable, so labels with the same start keep their order in labels.txt
+        ordered = sorted(range(len(labels)), key=lambda i: labels[i][0])
+        self.starts = [labels[i][0] for i in ordered]
+        self.ends = [labels[i][1] for i in ordered]
+        self.modes = [labels[i][2] for i in ordered]
+        self.positions = ordered
+        # Running maximum of the end times, to rule out trackpoints no label covers in bulk
+        self.max_ends = []
+        for end in self.ends:
+            self.max_ends.append(max(end, self.max_ends[-1]) if self.max_ends else end)
+        # Max end segment tree, leaves at size + i and node k covering its children 2k and 2k + 1
+        self.size = 1
+        while self.size < len(self.ends):
+            self.size *= 2
+        self.tree = [datetime.datetime.min] * (2 * self.size)
+        self.tree[self.size:self.size + len(self.ends)] = self.ends
+        for node in range(self.size - 1, 0, -1):
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+        # Exact (start, end) lookups, the first label in labels.txt wins like in a linear scan
+        self.exact = {}
+        for start, end, mode in labels:
+            self.exact.setdefault((start, end), mode)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def overlapping(self, start: datetime.datetime, end: datetime.datetime) -> Iterator[int]:
+        """
+        Indices of the sorted labels sharing at least one instant with [start, end].
+        """
+        count = bisect.bisect_right(self.starts, end)
+        stack = [(1, 0, self.size)]
+        while stack:
+            node, first, width = stack.pop()
+            if first >= count or self.tree[node] < start:
+                continue
+            if width == 1:
+                yield first
+                continue
+            half = width // 2
+            stack.append((2 * node + 1, first + half, half))
+            stack.append((2 * node, first, half))
+
+    def last_covering(self, date_time: datetime.datetime, count: int) -> int:
+        """
+        Index of the latest starting label among the first count sorted labels that is
+        still running at date_time, or -1. Descends right first, O(log labels).
+        """
+        stack = [(1, 0, self.size)]
+        while stack:
+            node, first, width = stack.pop()
+            if first >= count or self.tree[node] < date_time:
+                continue
+            if width == 1:
+                return first
+            half = width // 2
+            stack.append((2 * node, first, half))
+            stack.append((2 * node + 1, first + half, half))
+        return -1
+
+    def match(self, start: datetime.datetime, end: datetime.datetime,
+              min_overlap: float = None) -> Optional[str]:
+        """
+        The mode of the label with exactly this interval if min_overlap is None. Otherwise
+        the mode of the label covering the largest part of [start, end], if that part is
+        at least min_overlap of the interval (0 accepts any overlap, 1 needs full cover).
+        Ties go to the label listed first in labels.txt.
+        """
+        if min_overlap is None:
+            return self.exact.get((start, end))
+
+        duration = (end - start).total_seconds()
+        best, best_overlap = None, None
+        for i in self.overlapping(start, end):
+            overlap = (min(end, self.ends[i]) - max(start, self.starts[i])).total_seconds()
+            if (best is None or overlap > best_overlap
+                    or (overlap == best_overlap and self.positions[i] < self.positions[best])):
+                best, best_overlap = i, overlap
+        if best is None:
+            return None
+        ratio = best_overlap / duration if duration > 0 else 1.0
+        return self.modes[best] if ratio >= min_overlap else None
+
+    def segments(self, date_time: np.ndarray) -> List[Dict]:
+        """
+        Label the trackpoints of an activity one by one: each gets the mode of the latest
+        starting label that covers it. Returns the runs of consecutive
+        labeled trackpoints with the same mode as
+        {mode, start_index, end_index, start_date_time, end_date_time}, end inclusive.
+        """
+        if not len(self) or not len(date_time):
+            return []
+        starts = np.array(self.starts, dtype='datetime64[s]')
+        ends = np.array(self.ends, dtype='datetime64[s]')
+        max_ends = np.array(self.max_ends, dtype='datetime64[s]')
+        counts = np.searchsorted(starts, date_time, side='right')
+        labels = counts - 1
+        # The latest label starting before a trackpoint usually covers it. If it does not,
+        # an earlier and longer one still might, unless no label up to it runs that long
+        started = counts > 0
+        covered = np.zeros(len(date_time), dtype=bool)
+        covered[started] = ends[labels[started]] >= date_time[started]
+        reachable = np.zeros(len(date_time), dtype=bool)
+        reachable[started] = max_ends[labels[started]] >= date_time[started]
+        labels[~reachable] = -1
+        for i in np.flatnonzero(reachable & ~covered):
+            labels[i] = self.last_covering(date_time[i].item(), counts[i])
+
+        segments = []
+        # Split wherever the label changes
+        boundaries = np.flatnonzero(np.diff(labels)) + 1
+        for first, last in zip(np.r_[0, boundaries], np.r_[boundaries, len(labels)] - 1):
+            if labels[first] < 0:
+                continue
+            segments.append({
+                "mode": self.modes[labels[first]],
+                "start_index": int(first),
+                "end_index": int(last),
+                "start_date_time": date_time[first].item(),
+                "end_date_time": date_time[last].item()
+            })
+        # Neighbouring labels can have the same mode
+        merged = []
+        for segment in segments:
+            if (merged and merged[-1]["mode"] == segment["mode"]
+                    and merged[-1]["end_index"] + 1 == segment["start_index"]):
+                merged[-1]["end_index"] = segment["end_index"]
+                merged[-1]["end_date_time"] = segment["end_date_time"]
+            else:
+                merged.append(segment)
+        return merged
@@ -1,18 +1,95 @@
-from pymongo import MongoClient, ASCENDING
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
 import datetime
+from contextlib import nullcontext
 import os
-from typing import List, Dict, Any
+import sys
+from typing import List, Dict, Any, Tuple
 from tabulate import tabulate
+from functools import partial
 from DbConnector import DbConnector
+from dataset_catalog import scan_dataset
+from ingest_pipeline import BulkWriterPool, iter_parsed
+from label_index import LabelIndex
+from instrumentation import Metrics
+from plt_reader import MAX_TRACKPOINTS, read_plt_file
+from report_cache import bump_data_generation
+from query_stats import explain_commands, sum_docs_examined
+from rollups import REBUILD_PIPELINE, ROLLUP_FIELDS, add_to_rollups, move_mode_rollups, rebuild_rollups, reset_rollups
+from trackpoint_buckets import (BUCKET_SIZE, backfill_bucket_geometry, bucket_count, build_buckets,
+                                with_activity_columns)
+from trackpoint_codec import encode_columns, trackpoints_to_columns
+from trajectory_stats import activity_geometry, compute_activity_stats
+
+
+def parse_user_trajectories(user_id: str, trajectory_path: str, files: List[str] = None,
+                            verbose: bool = True, parser: str = 'python',
+                            max_trackpoints: int = MAX_TRACKPOINTS) -> Tuple[str, List[tuple]]:
+    """
+    Parse the .plt files of one user, all of them unless files is given. Runs inside
+    a worker process, so it only returns plain data and leaves all database writes
+    to the main process. Files with more than max_trackpoints are skipped, unless it is None.
+    """
+    parsed = []
+    for file in sorted(files if files is not None else os.listdir(trajectory_path)):
+        if not file.endswith('.plt'):
+            continue
+        activity_id_str = f"{user_id}{os.path.splitext(file)[0]}"
+        try:
+            activity_id = int(activity_id_str)
+        except ValueError:
+            if verbose:
+                print(f"Invalid activity_id generated: {activity_id_str}")
+            continue
+
+        result = read_plt_file(os.path.join(trajectory_path, file), activity_id, max_trackpoints,
+                               verbose=verbose, parser=parser)
+        if result:
+            activity_data, trackpoints = result
+            parsed.append((activity_id, activity_data, trackpoints))
+    return user_id, parsed
+
 
 class ActivityTrackerProgram:
-    def __init__(self):
+    def __init__(self, batch_size: int = 100, trackpoint_format: str = 'array', metrics: Metrics = None,
+                 bucket_size: int = BUCKET_SIZE, explain: bool = False):
         self.connection = DbConnector()
         self.db = self.connection.db
+        # Documents per insert_many call in the bulk ingest path
+        self.batch_size = batch_size
+        # 'array' embeds one subdocument per trackpoint, 'columnar' packs them
+        # into binary columns (see trackpoint_codec), 'bucketed' stores those columns
+        # in trackpoint_buckets documents of bucket_size trackpoints (see trackpoint_buckets)
+        self.trackpoint_format = trackpoint_format
+        self.bucket_size = bucket_size
+        self.pending_activities = []
+        self.pending_buckets = []
+        self.batch_errors = []
+        # Background BulkWriterPool that flush_activities hands its batches to, if any
+        self.writer = None
+        # Parsed labels and their (start, end) index per dataset path, read once per run
+        self.labels_cache = {}
+        self.label_index_cache = {}
+        # One scan of the dataset directory tree per dataset path, shared by every ingest stage
+        self.catalog_cache = {}
+        # Phase timings and counters, and whether per-file and per-line messages are printed
+        self.metrics = metrics or Metrics()
+        # Whether the aggregations are also run with explain("executionStats"), see explain_aggregate
+        self.explain = explain
+
+    def set_write_phase(self, phase: str):
+        """
+        Write with the write concern of phase from now on, e.g. 'ingest' for the
+        relaxed bulk ingest and 'default' afterwards (see DbConnector.write_concern).
+        """
+        self.db = self.connection.get_database(phase)
 
     def drop_collections(self):
         self.db.users.drop()
         self.db.activities.drop()
+        self.db.trackpoint_buckets.drop()
+        self.db.ingest_manifest.drop()
+        reset_rollups(self.db)
         print("Collections dropped successfully")
 
     def insert_user_data(self, user_id: str, has_labels: bool):
@@ -39,46 +116,273 @@ class ActivityTrackerProgram:
         }
         try:
             self.db.activities.insert_one(activity_doc)
+            return True
         except Exception as e:
             print(f"Error inserting activity {activity_id}: {e}")
+            return False
 
-    def insert_trackpoints_batch(self, activity_id: int, trackpoints: List[tuple]):
+    def insert_trackpoints_batch(self, activity_id: int, trackpoints: List[tuple], user_id: str = None):
         """
         Updated to use _id instead of activity_id for queries
         """
-        trackpoint_docs = []
-        for tp in trackpoints:
-            trackpoint_doc = {
+        columns = trackpoints_to_columns(trackpoints)
+        if self.trackpoint_format == 'bucketed':
+            try:
+                self.db.trackpoint_buckets.insert_many(
+                    build_buckets(activity_id, user_id, trackpoints, self.bucket_size)
+                )
+            except Exception as e:
+                print(f"Error inserting trackpoints for activity {activity_id}: {e}")
+                return
+            update = {
+                "$set": {"bucket_count": bucket_count(len(trackpoints), self.bucket_size),
+                         **self.compute_derived_fields(columns, geometry=False)},
+                "$unset": {"trackpoints": "", "geometry": ""}
+            }
+        elif self.trackpoint_format == 'columnar':
+            update = {
+                "$set": {"trackpoint_columns": encode_columns(columns), **self.compute_derived_fields(columns)},
+                "$unset": {"trackpoints": ""}
+            }
+        else:
+            update = {
+                "$push": {"trackpoints": {"$each": self.build_trackpoint_docs(trackpoints)}},
+                "$set": self.compute_derived_fields(columns)
+            }
+        try:
+            self.db.activities.update_one({"_id": activity_id}, update)
+        except Exception as e:
+            print(f"Error inserting trackpoints for activity {activity_id}: {e}")
+
+    @staticmethod
+    def build_trackpoint_docs(trackpoints: List[tuple]) -> List[Dict]:
+        return [
+            {
                 "lat": tp[1],
                 "lon": tp[2],
                 "altitude": tp[3],
                 "date_days": tp[4],
                 "date_time": tp[5]
             }
-            trackpoint_docs.append(trackpoint_doc)
+            for tp in trackpoints
+        ]
 
-        try:
-            self.db.activities.update_one(
-                {"_id": activity_id},  
-                {"$push": {"trackpoints": {"$each": trackpoint_docs}}}
-            )
-        except Exception as e:
-            print(f"Error inserting trackpoints for activity {activity_id}: {e}")
+    def build_activity_document(self, activity_id: int, user_id: str,
+                                activity_data: Dict, trackpoints: List[tuple]) -> Dict:
+        """
+        Build the complete activity document, trackpoints and their precomputed
+        statistics included, so it can be written with a single insert instead of
+        insert_one followed by $push. In the bucketed format the trackpoints go to
+        build_buckets instead and the document only records how many buckets there are.
+        """
+        columns = trackpoints_to_columns(trackpoints)
+        activity_doc = {
+            "_id": activity_id,
+            "user_id": user_id,
+            "transportation_mode": None,
+            "start_date_time": activity_data['start_date_time'],
+            "end_date_time": activity_data['end_date_time'],
+            **self.compute_derived_fields(columns, geometry=self.trackpoint_format != 'bucketed')
+        }
+        if self.trackpoint_format == 'bucketed':
+            activity_doc["bucket_count"] = bucket_count(len(trackpoints), self.bucket_size)
+        elif self.trackpoint_format == 'columnar':
+            activity_doc["trackpoint_columns"] = encode_columns(columns)
+        else:
+            activity_doc["trackpoints"] = self.build_trackpoint_docs(trackpoints)
+        return activity_doc
+
+    @staticmethod
+    def compute_derived_fields(columns: Dict, geometry: bool = True) -> Dict:
+        """
+        Fields computed from the trackpoints once at ingest so the reports do not have
+        to read them: the statistics from compute_activity_stats and, unless geometry
+        is False, a GeoJSON 'geometry' covering the path (its bounding box, see
+        activity_geometry) for the 2dsphere index. Bucketed activities keep their
+        geometry on the buckets instead.
+        """
+        fields = compute_activity_stats(columns)
+        if geometry:
+            fields["geometry"] = activity_geometry(columns['lat'], columns['lon'])
+        return fields
+
+    def backfill_activity_stats(self, only_missing: bool = True):
+        """
+        Compute the trackpoint statistics and geometry of activities that were ingested
+        without them (or of all activities if only_missing is False) and store them in bulk.
+        Bucketed activities get no geometry of their own, their buckets get one instead.
+        """
+        query = {}
+        if only_missing:
+            query = {"$or": [
+                {"trackpoint_count": {"$exists": False}},
+                {"geometry": {"$exists": False}, "bucket_count": {"$exists": False}},
+                # Full paths stored before geometries became bounding boxes
+                {"geometry.type": "LineString", "bucket_count": {"$exists": False}},
+                {"geometry": {"$exists": True}, "bucket_count": {"$exists": True}}
+            ]}
+        projection = {"trackpoints": 1, "trackpoint_columns": 1, "bucket_count": 1}
+        updates = []
+        updated = 0
+        activities = with_activity_columns(
+            self.db.trackpoint_buckets,
+            self.db.activities.find(query, projection, batch_size=self.batch_size),
+            ['lat', 'lon', 'altitude', 'date_time'],
+            self.batch_size
+        )
+        for activity, columns in activities:
+            if "bucket_count" in activity:
+                update = {"$set": self.compute_derived_fields(columns, geometry=False),
+                          "$unset": {"geometry": ""}}
+            else:
+                update = {"$set": self.compute_derived_fields(columns)}
+            updates.append(UpdateOne({"_id": activity["_id"]}, update))
+            if len(updates) >= self.batch_size:
+                updated += self.db.activities.bulk_write(updates, ordered=False).modified_count
+                updates = []
+        if updates:
+            updated += self.db.activities.bulk_write(updates, ordered=False).modified_count
+        self.metrics.incr('activities_backfilled', updated)
+        print(f"Backfilled trackpoint statistics and geometry of {updated} activities")
+
+        buckets = backfill_bucket_geometry(self.db.trackpoint_buckets, only_missing, self.batch_size)
+        if buckets:
+            print(f"Backfilled the geometry of {buckets} trackpoint buckets")
+
+    def insert_documents_bulk(self, collection_name: str, docs: List[Dict]) -> List[Dict]:
+        """
+        Insert documents with unordered insert_many in batches of self.batch_size.
+        A failing document does not stop the rest of its batch; the errors of each
+        batch are collected in self.batch_errors and returned.
+        """
+        errors = []
+        for start in range(0, len(docs), self.batch_size):
+            batch = docs[start:start + self.batch_size]
+            try:
+                self.db[collection_name].insert_many(batch, ordered=False)
+                self.metrics.incr('documents_written', len(batch))
+            except BulkWriteError as e:
+                self.metrics.incr('documents_written', e.details.get("nInserted", 0))
+                self.metrics.incr('errors', len(e.details.get("writeErrors", [])))
+                errors.append({
+                    "collection": collection_name,
+                    "first_id": batch[0]["_id"],
+                    "inserted": e.details.get("nInserted", 0),
+                    "errors": [
+                        {"_id": batch[err["index"]]["_id"], "code": err.get("code"), "errmsg": err.get("errmsg")}
+                        for err in e.details.get("writeErrors", [])
+                    ]
+                })
+            except Exception as e:
+                self.metrics.incr('errors', len(batch))
+                errors.append({
+                    "collection": collection_name,
+                    "first_id": batch[0]["_id"],
+                    "inserted": 0,
+                    "errors": [{"_id": None, "code": None, "errmsg": str(e)}]
+                })
+        self.batch_errors.extend(errors)
+        return errors
+
+    def queue_activity(self, activity_doc: Dict, buckets: List[Dict] = None):
+        self.pending_activities.append(activity_doc)
+        self.pending_buckets.extend(buckets or [])
+        if len(self.pending_activities) >= self.batch_size:
+            self.flush_activities()
+
+    def flush_activities(self):
+        """
+        Write the queued activities, or hand them to self.writer to be written in the
+        background while the next batch is built.
+        """
+        if self.pending_activities:
+            docs, self.pending_activities = self.pending_activities, []
+            buckets, self.pending_buckets = self.pending_buckets, []
+            if self.writer:
+                self.writer.submit(docs, buckets)
+            else:
+                self.write_activities(docs, buckets)
+
+    def write_activities(self, docs: List[Dict], buckets: List[Dict]):
+        """
+        Write a batch of activities, after their trackpoint buckets if there are any.
+        An activity whose buckets could not all be written is not inserted, and the
+        buckets that were written are removed again, so it is retried as a whole.
+        """
+        bucket_errors = self.insert_documents_bulk('trackpoint_buckets', buckets)
+        failed = self.failed_bucket_activities(buckets, bucket_errors)
+        if failed:
+            self.db.trackpoint_buckets.delete_many({"activity_id": {"$in": list(failed)}})
+        errors = self.insert_documents_bulk('activities', [doc for doc in docs if doc['_id'] not in failed])
+        failed = self.mark_manifest_written(docs, errors, failed)
+        add_to_rollups(self.db, [doc for doc in docs if doc['_id'] not in failed])
+
+    @staticmethod
+    def failed_bucket_activities(buckets: List[Dict], errors: List[Dict]) -> set:
+        activity_ids = {bucket['_id']: bucket['activity_id'] for bucket in buckets}
+        if any(err['_id'] is None for batch in errors for err in batch['errors']):
+            return set(activity_ids.values())
+        return {activity_ids[err['_id']] for batch in errors for err in batch['errors']}
+
+    def print_batch_errors(self, batch_errors: List[Dict]):
+        for batch in batch_errors:
+            print(f"Error: batch into {batch['collection']} starting at _id {batch['first_id']} "
+                  f"inserted {batch['inserted']} documents and had {len(batch['errors'])} errors")
+            for err in batch['errors']:
+                self.metrics.log(f"  _id {err['_id']}: {err['errmsg']}")
 
     def create_collections(self):
             # Create indexes
             self.db.users.create_index([("has_labels", ASCENDING)])
             self.db.activities.create_index([("user_id", ASCENDING)])
+            self.db.activities.create_index([
+                ("user_id", ASCENDING), ("transportation_mode", ASCENDING), ("start_date_time", ASCENDING)
+            ])
+            self.db.activities.create_index([("max_gap_seconds", DESCENDING)])
+            self.db.activities.create_index([("trackpoint_count", ASCENDING)])
+            self.db.activities.create_index([("geometry", "2dsphere"), ("start_date_time", ASCENDING)])
+            self.db.trackpoint_buckets.create_index([("activity_id", ASCENDING), ("seq", ASCENDING)], unique=True)
+            self.db.trackpoint_buckets.create_index([("user_id", ASCENDING), ("start_date_time", ASCENDING)])
+            self.db.trackpoint_buckets.create_index([("start_date_time", ASCENDING), ("end_date_time", ASCENDING)])
+            self.db.trackpoint_buckets.create_index([("geometry", "2dsphere"), ("start_date_time", ASCENDING)])
+            self.db.ingest_manifest.create_index([("activity_id", ASCENDING)])
             print("Collections and indexes created successfully")
 
-    def fetch_data(self, collection_name: str):
-        docs = list(self.db[collection_name].find({}, {'_id': 0}))
-        if docs:
-            headers = docs[0].keys()
-            rows = [[str(doc[header]) for header in headers] for doc in docs]
-            print(f"Data from collection {collection_name}, tabulated:")
+    def fetch_data(self, collection_name: str, projection: Dict = None, page_size: int = 1000,
+                   after_id: Any = None, limit: int = None, trackpoint_limit: int = 10) -> Any:
+        """
+        Print a collection as tables of page_size documents, paging through it by _id so
+        only one page is held in memory. By default the packed trackpoint_columns are left
+        out, as is the geometry, and the trackpoint and mode_segments arrays are cut to
+        trackpoint_limit on the server with $slice.
+        Starts after after_id and stops after limit documents, if given, and returns the
+        last _id printed, so an interrupted listing can be resumed from there.
+        """
+        if projection is None:
+            projection = {"trackpoint_columns": 0, "geometry": 0, "trackpoints": {"$slice": trackpoint_limit},
+                          "mode_segments": {"$slice": trackpoint_limit}}
+        # _id is needed to find the next page
+        projection = {key: value for key, value in projection.items() if key != '_id'} or None
+
+        headers = None
+        last_id = after_id
+        printed = 0
+        while limit is None or printed < limit:
+            query = {} if last_id is None else {"_id": {"$gt": last_id}}
+            size = page_size if limit is None else min(page_size, limit - printed)
+            page = list(self.db[collection_name].find(query, projection).sort("_id", ASCENDING).limit(size))
+            if not page:
+                break
+            if headers is None:
+                headers = list(page[0].keys())
+                print(f"Data from collection {collection_name}, tabulated:")
+            rows = [[str(doc.get(header, '')) for header in headers] for doc in page]
             print(tabulate(rows, headers=headers))
-        return docs
+            printed += len(page)
+            last_id = page[-1]["_id"]
+            if len(page) < size:
+                break
+        return last_id
 
     def show_collections(self):
         collections = self.db.list_collection_names()
@@ -86,166 +390,295 @@ class ActivityTrackerProgram:
         for collection in collections:
             print(f"- {collection}")
 
-    def populate_user_table(self, dataset_path: str):
+    def populate_user_table(self, dataset_path: str, bulk: bool = True, incremental: bool = False):
         labeled_ids_path = os.path.join(dataset_path, 'dataset', 'labeled_ids.txt')
         
         with open(labeled_ids_path, 'r') as f:
             labeled_ids = set(f.read().splitlines())
         
-        processed_users = set()
-        data_path = os.path.join(dataset_path, 'dataset', 'Data')
-        
-        for root, dirs, files in os.walk(data_path):
-            for dir in dirs:
-                if dir == "Trajectory":
-                    continue
-                    
-                user_id = dir
-                if user_id in processed_users:
-                    continue
-
-                has_labels = user_id in labeled_ids
+        user_docs = []
+        for user_id in self.get_catalog(dataset_path)['users']:
+            has_labels = user_id in labeled_ids
+            if bulk or incremental:
+                user_docs.append({"_id": user_id, "has_labels": has_labels})
+            else:
                 self.insert_user_data(user_id, has_labels)
-                processed_users.add(user_id)
-        
+
+        if incremental:
+            # Users may already exist, so upsert them instead of inserting
+            for start in range(0, len(user_docs), self.batch_size):
+                self.db.users.bulk_write([
+                    UpdateOne({"_id": doc["_id"]}, {"$set": {"has_labels": doc["has_labels"]}}, upsert=True)
+                    for doc in user_docs[start:start + self.batch_size]
+                ], ordered=False)
+        elif bulk:
+            self.print_batch_errors(self.insert_documents_bulk('users', user_docs))
         print("Users collection populated successfully")
 
-    def populate_activities(self, dataset_path: str):
-        data_path = os.path.join(dataset_path, 'dataset', 'Data')
-        
-        for root, dirs, files in os.walk(data_path):
-            if 'Trajectory' in root:
-                user_id = os.path.basename(os.path.dirname(root))
-                for file in files:
-                    if file.endswith('.plt'):
-                        activity_id_str = f"{user_id}{os.path.splitext(file)[0]}"
-                        try:
-                            activity_id = int(activity_id_str)
-                        except ValueError:
-                            print(f"Invalid activity_id generated: {activity_id_str}")
-                            continue
-
-                        file_path = os.path.join(root, file)
-                        activity_data = self.process_activity_file(file_path)
-                        
-                        if activity_data:
-                            self.insert_activity_data(activity_id, user_id, activity_data)
-                            trackpoints = self.process_trackpoints(file_path, activity_id)
-                            if trackpoints:
-                                self.insert_trackpoints_batch(activity_id, trackpoints)
-        
+    def populate_activities(self, dataset_path: str, workers: int = 1, bulk: bool = True,
+                            incremental: bool = False, parser: str = 'numpy', writers: int = 0,
+                            write_queue: int = None):
+        """
+        Parse all .plt files and insert the activities. With workers > 1 the
+        parsing is sharded by user over a process pool while this process
+        keeps doing the database writes as results come in. With bulk the
+        complete activity documents are written in unordered batches and every
+        file is recorded in the ingest_manifest collection.
+        With incremental (which implies bulk) only new, changed or unfinished
+        files are ingested, and activities whose files disappeared are deleted.
+        parser selects the .plt parser, see plt_reader.read_plt_file.
+        With bulk and writers > 0 the ingest runs as a pipeline: the scanned files
+        are parsed by the pool, this process builds the documents, and writers
+        threads write the batches, with at most write_queue batches waiting for a
+        writer (see ingest_pipeline). A failing stage stops the others and its
+        error is raised here; files whose batches were not written stay pending
+        in the manifest for the next incremental run.
+        """
+        errors_before = len(self.batch_errors)
+        bulk = bulk or incremental
+
+        trajectory_files = self.get_catalog(dataset_path)['trajectory_files']
+        if bulk:
+            trajectory_files = self.plan_manifest(trajectory_files, incremental)
+        self.metrics.incr('files', len(trajectory_files))
+        self.metrics.incr('bytes', sum(entry['size'] for entry in trajectory_files.values()))
+
+        # Shard the files to parse by user
+        user_files = {}
+        for entry in trajectory_files.values():
+            root, files = user_files.setdefault(entry['user_id'], (entry['root'], []))
+            files.append(entry['file'])
+
+        parse = partial(parse_user_trajectories, verbose=self.metrics.verbose, parser=parser,
+                        max_trackpoints=self.max_trackpoints)
+        writer = BulkWriterPool(self.write_activities, writers, write_queue) if bulk and writers > 0 \
+            else nullcontext()
+        # Leaving the block waits for the queued batches, or drops them on an error
+        with writer as self.writer:
+            try:
+                for _, (user_id, parsed), (_, files) in iter_parsed(parse, user_files, workers):
+                    self.insert_parsed_activities(user_id, parsed, bulk, files)
+                self.flush_activities()
+            finally:
+                self.writer = None
+
+        self.print_batch_errors(self.batch_errors[errors_before:])
         print("Activities collection populated successfully")
 
-    def process_activity_file(self, file_path: str) -> Dict:
-        try:
-            with open(file_path, 'r') as f:
-                lines = f.readlines()[6:]
-                
-                if len(lines) > 2500:
-                    print(f"Skipping file {file_path} due to too many trackpoints ({len(lines)}).")
-                    return None
+    @property
+    def max_trackpoints(self) -> int:
+        # Buckets keep documents small however long a trajectory is, so there is no cap
+        return None if self.trackpoint_format == 'bucketed' else MAX_TRACKPOINTS
 
-                start_time = None
-                end_time = None
-                
-                for line_num, line in enumerate(lines, start=7):
-                    try:
-                        parts = line.strip().split(',')
-                        if len(parts) >= 7:
-                            date = parts[5]
-                            time = parts[6]
-                            date_string = f"{date} {time}"
-                            current_time = datetime.datetime.strptime(date_string, "%Y-%m-%d %H:%M:%S")
-                            
-                            if start_time is None:
-                                start_time = current_time
-                            end_time = current_time
-                    except Exception as e:
-                        print(f"Error processing line {line_num} in file {file_path}: {e}")
-                        continue
-
-                if start_time and end_time:
-                    return {
-                        'start_date_time': start_time,
-                        'end_date_time': end_time
-                    }
-                return None
-        except Exception as e:
-            print(f"Error processing file {file_path}: {e}")
-            return None
+    def get_catalog(self, dataset_path: str) -> Dict:
+        """
+        Users, labels.txt locations and .plt files of the dataset, scanned once per
+        dataset path (see dataset_catalog.scan_dataset).
+        """
+        if dataset_path not in self.catalog_cache:
+            self.catalog_cache[dataset_path] = scan_dataset(dataset_path, self.metrics.verbose)
+        return self.catalog_cache[dataset_path]
 
-    def process_trackpoints(self, file_path: str, activity_id: int) -> List[tuple]:
-        try:
-            with open(file_path, 'r') as f:
-                lines = f.readlines()[6:]
-                
-                if len(lines) > 2500:
-                    return None
-
-                trackpoints = []
-                for line in lines:
-                    parts = line.strip().split(',')
-                    if len(parts) >= 7:
-                        lat, lon = float(parts[0]), float(parts[1])
-                        altitude = int(float(parts[3]))
-                        date_days = float(parts[4])
-                        date_string = f"{parts[5]} {parts[6]}"
-                        date_time = datetime.datetime.strptime(date_string, "%Y-%m-%d %H:%M:%S")
-                        
-                        trackpoints.append((activity_id, lat, lon, altitude, date_days, date_time))
+    def plan_manifest(self, trajectory_files: Dict[str, Dict], incremental: bool) -> Dict[str, Dict]:
+        """
+        Compare the scanned files against ingest_manifest and return the ones that
+        have to be ingested. Files that are not completed, or whose size or mtime
+        changed, are marked pending and their old activities deleted, so an
+        interrupted run picks them up again. Activities of files that disappeared
+        are deleted together with their manifest entries.
+        """
+        manifest = {}
+        if incremental:
+            manifest = {doc['_id']: doc for doc in self.db.ingest_manifest.find()}
+
+        removed = [doc for path, doc in manifest.items() if path not in trajectory_files]
+        for start in range(0, len(removed), self.batch_size):
+            batch = removed[start:start + self.batch_size]
+            self.delete_activities([doc['activity_id'] for doc in batch])
+            self.db.ingest_manifest.delete_many({"_id": {"$in": [doc['_id'] for doc in batch]}})
+        if removed:
+            print(f"Removed {len(removed)} activities whose files disappeared")
+
+        pending = {}
+        for path, entry in trajectory_files.items():
+            doc = manifest.get(path)
+            if (doc and doc['state'] in ('completed', 'skipped')
+                    and doc['size'] == entry['size'] and doc['mtime'] == entry['mtime']):
+                continue
+            pending[path] = entry
+
+        paths = list(pending)
+        for start in range(0, len(paths), self.batch_size):
+            batch = paths[start:start + self.batch_size]
+            self.db.ingest_manifest.bulk_write([
+                ReplaceOne({"_id": path}, {
+                    "user_id": pending[path]['user_id'],
+                    "activity_id": pending[path]['activity_id'],
+                    "size": pending[path]['size'],
+                    "mtime": pending[path]['mtime'],
+                    "state": "pending",
+                    "updated_at": datetime.datetime.utcnow()
+                }, upsert=True)
+                for path in batch
+            ], ordered=False)
+            if incremental:
+                self.delete_activities([pending[path]['activity_id'] for path in batch])
+
+        print(f"{len(pending)} of {len(trajectory_files)} trajectory files need to be ingested")
+        return pending
+
+    def delete_activities(self, activity_ids: List[int]):
+        """
+        Delete activities with their trackpoint buckets and take them out of the rollups.
+        """
+        existing = list(self.db.activities.find({"_id": {"$in": activity_ids}}, ROLLUP_FIELDS))
+        if existing:
+            self.db.activities.delete_many({"_id": {"$in": [activity['_id'] for activity in existing]}})
+            add_to_rollups(self.db, existing, sign=-1)
+        self.db.trackpoint_buckets.delete_many({"activity_id": {"$in": activity_ids}})
+
+    def set_manifest_state(self, activity_ids: List[int], state: str):
+        if activity_ids:
+            self.db.ingest_manifest.update_many(
+                {"activity_id": {"$in": activity_ids}},
+                {"$set": {"state": state, "updated_at": datetime.datetime.utcnow()}}
+            )
 
-                return trackpoints
-        except Exception as e:
-            print(f"Error processing trackpoints in file {file_path}: {e}")
-            return None
+    def mark_manifest_written(self, docs: List[Dict], errors: List[Dict], failed_ids: set = None):
+        failed = {err['_id'] for batch in errors for err in batch['errors']} | (failed_ids or set())
+        if any(err['_id'] is None for batch in errors for err in batch['errors']):
+            # The whole insert failed, so nothing in this flush can be trusted
+            failed = {doc['_id'] for doc in docs}
+        self.set_manifest_state([doc['_id'] for doc in docs if doc['_id'] not in failed], 'completed')
+        self.set_manifest_state(list(failed), 'failed')
+        return failed
+
+    def insert_parsed_activities(self, user_id: str, parsed: List[tuple], bulk: bool = True,
+                                 files: List[str] = None):
+        self.metrics.incr('activities', len(parsed))
+        self.metrics.incr('trackpoints', sum(len(trackpoints) for _, _, trackpoints in parsed))
+        if files is not None:
+            self.metrics.incr('files_skipped', len(files) - len(parsed))
+
+        if bulk and files is not None:
+            # Files that gave no activity (oversized or empty) are done as well
+            parsed_ids = {activity_id for activity_id, _, _ in parsed}
+            self.set_manifest_state([
+                activity_id for activity_id in (int(f"{user_id}{os.path.splitext(file)[0]}") for file in files)
+                if activity_id not in parsed_ids
+            ], 'skipped')
+
+        for activity_id, activity_data, trackpoints in parsed:
+            if bulk:
+                buckets = None
+                if self.trackpoint_format == 'bucketed':
+                    buckets = build_buckets(activity_id, user_id, trackpoints, self.bucket_size)
+                self.queue_activity(
+                    self.build_activity_document(activity_id, user_id, activity_data, trackpoints), buckets
+                )
+                continue
+            if self.insert_activity_data(activity_id, user_id, activity_data):
+                add_to_rollups(self.db, [{**activity_data, "user_id": user_id, "trackpoint_count": len(trackpoints)}])
+            if trackpoints:
+                self.insert_trackpoints_batch(activity_id, trackpoints, user_id)
 
-    def update_transportation_modes(self, dataset_path: str):
-        labels = self.read_labels(dataset_path)
+    def update_transportation_modes(self, dataset_path: str, min_overlap: float = None,
+                                    segments: bool = False):
+        """
+        Set the transportation mode of every activity matching a label, see
+        find_matching_label for min_overlap. With segments, the trackpoints are labeled
+        one by one as well and the runs with the same mode stored as mode_segments.
+        """
+        label_index = self.get_label_index(dataset_path)
         users_with_labels = self.get_users_with_labels()
+        updates = []
+        # (activity, new mode) of the activities in updates whose mode changes
+        mode_changes = []
 
         for user_id in users_with_labels:
-            if user_id not in labels:
+            if user_id not in label_index:
                 print(f"Error: User {user_id} has has_labels set to true, but no transportation labels were found.")
                 continue
 
-            activities = self.get_user_activities(user_id)
+            activities = self.get_user_activities(user_id, with_timestamps=segments)
+            if segments:
+                activities = with_activity_columns(self.db.trackpoint_buckets, activities, ['date_time'])
+            else:
+                activities = ((activity, None) for activity in activities)
             labels_found = False
 
-            for activity in activities:
-                transportation_mode = self.find_matching_label(user_id, activity, labels)
+            for activity, columns in activities:
+                transportation_mode = self.find_matching_label(user_id, activity, label_index, min_overlap)
+                fields = {}
                 if transportation_mode:
-                    self.update_activity_transportation_mode(activity['_id'], transportation_mode)
+                    fields["transportation_mode"] = transportation_mode
+                    if transportation_mode != activity.get('transportation_mode'):
+                        mode_changes.append((activity, transportation_mode))
+                if segments:
+                    mode_segments = label_index[user_id].segments(columns['date_time'])
+                    if mode_segments:
+                        fields["mode_segments"] = mode_segments
+                if fields:
+                    updates.append(UpdateOne({"_id": activity['_id']}, {"$set": fields}))
                     labels_found = True
 
+            if len(updates) >= self.batch_size:
+                self.db.activities.bulk_write(updates, ordered=False)
+                move_mode_rollups(self.db, mode_changes)
+                self.metrics.incr('modes_updated', len(updates))
+                updates, mode_changes = [], []
+
             if not labels_found:
                 print(f"Error: User {user_id} has has_labels set to true, but no matching transportation labels were found.")
 
+        if updates:
+            self.db.activities.bulk_write(updates, ordered=False)
+            move_mode_rollups(self.db, mode_changes)
+            self.metrics.incr('modes_updated', len(updates))
         print("Transportation modes updated successfully")
 
     def get_users_with_labels(self) -> List[str]:
         return [doc['_id'] for doc in self.db.users.find({"has_labels": True})]
 
-    def get_user_activities(self, user_id: str) -> List[Dict]:
-        return list(self.db.activities.find(
-            {"user_id": user_id},
-            {
-                "start_date_time": 1,
-                "end_date_time": 1
-            }
-        ))
+    def get_user_activities(self, user_id: str, with_timestamps: bool = False) -> List[Dict]:
+        # The rollup fields as well, to move the activity between modes in the rollups
+        projection = dict(ROLLUP_FIELDS)
+        if with_timestamps:
+            # Enough of every trackpoint format for with_activity_columns(..., ['date_time'])
+            projection.update({"trackpoints.date_time": 1, "trackpoint_columns.date_time": 1,
+                               "trackpoint_columns.start": 1, "bucket_count": 1})
+        return list(self.db.activities.find({"user_id": user_id}, projection))
     def update_activity_transportation_mode(self, activity_id: int, transportation_mode: str):
-        self.db.activities.update_one(
+        activity = self.db.activities.find_one_and_update(
             {"_id": activity_id}, 
-            {"$set": {"transportation_mode": transportation_mode}}
+            {"$set": {"transportation_mode": transportation_mode}},
+            projection=ROLLUP_FIELDS
         )
+        if activity and activity.get('transportation_mode') != transportation_mode:
+            move_mode_rollups(self.db, [(activity, transportation_mode)])
+
 
+    def get_label_index(self, dataset_path: str) -> Dict[str, LabelIndex]:
+        """
+        Index the labels of every user (see label_index.LabelIndex), so an activity is
+        matched with a dict lookup or a bisect instead of a scan over all labels of its user.
+        """
+        if dataset_path not in self.label_index_cache:
+            self.label_index_cache[dataset_path] = {
+                user_id: LabelIndex(user_labels)
+                for user_id, user_labels in self.read_labels(dataset_path).items()
+            }
+        return self.label_index_cache[dataset_path]
 
     def read_labels(self, dataset_path: str) -> Dict:
+        if dataset_path in self.labels_cache:
+            return self.labels_cache[dataset_path]
+
         print("\nStarting to read transportation mode labels...")
         labels = {}
         labeled_ids_path = os.path.join(dataset_path, 'dataset', 'labeled_ids.txt')
         
-        print(f"Reading labeled IDs from: {labeled_ids_path}")
+        self.metrics.log(f"Reading labeled IDs from: {labeled_ids_path}")
         try:
             with open(labeled_ids_path, 'r') as f:
                 labeled_ids = set(f.read().splitlines())
@@ -254,17 +687,18 @@ class ActivityTrackerProgram:
             print(f"Error reading labeled_ids.txt: {e}")
             return {}
         
+        catalog_users = self.get_catalog(dataset_path)['users']
         for user_id in labeled_ids:
-            print(f"\nProcessing labels for user: {user_id}")
-            labels_file = os.path.join(dataset_path, 'dataset', 'Data', user_id, 'labels.txt')
+            self.metrics.log(f"\nProcessing labels for user: {user_id}")
+            labels_file = catalog_users.get(user_id, {}).get('labels_file')
             
-            if os.path.exists(labels_file):
-                print(f"Found labels file: {labels_file}")
+            if labels_file:
+                self.metrics.log(f"Found labels file: {labels_file}")
                 try:
                     with open(labels_file, 'r') as f:
                         user_labels = []
                         lines = f.readlines()
-                        print(f"Found {len(lines)-1} label entries")
+                        self.metrics.log(f"Found {len(lines)-1} label entries")
                         
                         for line_num, line in enumerate(lines[1:], start=2):
                             try:
@@ -275,98 +709,246 @@ class ActivityTrackerProgram:
                                     mode = parts[2]
                                     user_labels.append((start_time, end_time, mode))
                                 else:
-                                    print(f"Warning: Line {line_num} has incorrect format: {line.strip()}")
+                                    self.metrics.log(f"Warning: Line {line_num} has incorrect format: {line.strip()}")
                             except Exception as e:
-                                print(f"Error processing line {line_num}: {e}")
-                                print(f"Line content: {line.strip()}")
+                                self.metrics.log(f"Error processing line {line_num}: {e}")
+                                self.metrics.log(f"Line content: {line.strip()}")
                                 continue
                         
                         labels[user_id] = user_labels
-                        print(f"Successfully added {len(user_labels)} labels for user {user_id}")
+                        self.metrics.log(f"Successfully added {len(user_labels)} labels for user {user_id}")
                 except Exception as e:
                     print(f"Error reading labels file for user {user_id}: {e}")
             else:
-                print(f"Warning: No labels file found for user {user_id} at {labels_file}")
+                expected_file = os.path.join(dataset_path, 'dataset', 'Data', user_id, 'labels.txt')
+                self.metrics.log(f"Warning: No labels file found for user {user_id} at {expected_file}")
         
+        self.labels_cache[dataset_path] = labels
         return labels
-    def find_matching_label(self, user_id: str, activity: Dict, labels: Dict) -> str:
-        if user_id not in labels:
+
+    def find_matching_label(self, user_id: str, activity: Dict, label_index: Dict,
+                            min_overlap: float = None) -> str:
+        """
+        With min_overlap None a label matches only if its start and end equal those of the
+        activity. Otherwise the label overlapping the activity the most matches if it
+        covers at least min_overlap (0 to 1) of the activity's duration.
+        """
+        if user_id not in label_index:
             return None
-        
-        for start_time, end_time, mode in labels[user_id]:
-            if (start_time == activity['start_date_time'] and 
-                end_time == activity['end_date_time']):
-                return mode
-        
-        return None
 
-    def verify_transportation_modes(self, dataset_path: str):
-        labels = self.read_labels(dataset_path)
+        return label_index[user_id].match(activity['start_date_time'], activity['end_date_time'], min_overlap)
+
+    def verify_transportation_modes(self, dataset_path: str, sample_size: int = 0,
+                                    max_mismatch_samples: int = 20, min_overlap: float = None) -> Dict:
+        """
+        Check the stored transportation modes against labels.txt in one streamed pass
+        over the projected activities of all labeled users. With sample_size > 0 only
+        that many randomly chosen activities are checked.
+        Returns a report with totals, counts per user and per mode, and at most
+        max_mismatch_samples of the inconsistent activities.
+        """
+        label_index = self.get_label_index(dataset_path)
         users_with_labels = self.get_users_with_labels()
-        
-        total_activities = 0
-        correct_activities = 0
-        inconsistent_activities = []
 
-        for user_id in users_with_labels:
-            if user_id not in labels:
-                print(f"Error: User {user_id} has has_labels set to true, but no labels file was found.")
+        missing_labels = [user_id for user_id in users_with_labels if user_id not in label_index]
+        for user_id in missing_labels:
+            print(f"Error: User {user_id} has has_labels set to true, but no labels file was found.")
+
+        report = {
+            "sampled": sample_size > 0,
+            "total": 0,
+            "labeled": 0,
+            "correct": 0,
+            "mismatches": 0,
+            "per_user": {},
+            "per_mode": {},
+            "missing_labels": missing_labels,
+            "mismatch_samples": []
+        }
+
+        checked_users = [user_id for user_id in users_with_labels if user_id in label_index]
+        for activity in self.get_labeled_activities(checked_users, sample_size):
+            user_id = activity['user_id']
+            user_counts = report["per_user"].setdefault(
+                user_id, {"total": 0, "labeled": 0, "correct": 0, "mismatches": 0}
+            )
+            report["total"] += 1
+            user_counts["total"] += 1
+
+            label_mode = self.find_matching_label(user_id, activity, label_index, min_overlap)
+            if label_mode is None:
                 continue
-            
-            activities = self.get_user_activities_with_transportation(user_id)
-            
-            for activity in activities:
-                total_activities += 1
-                label_mode = self.find_matching_label(user_id, activity, labels)
-                
-                if label_mode is not None:
-                    if label_mode == activity['transportation_mode']:
-                        correct_activities += 1
-                    else:
-                        inconsistent_activities.append({
-                            'user_id': user_id,
-                            'activity_id': activity['_id'], 
-                            'db_mode': activity['transportation_mode'],
-                            'label_mode': label_mode
-                        })
-
-        print(f"Verification complete. {correct_activities} out of {total_activities} activities with labels are correct.")
-        
-        if inconsistent_activities:
-            print("\nInconsistent activities found:")
-            for activity in inconsistent_activities:
-                print(f"User: {activity['user_id']}, Activity: {activity['_id']}, "
+
+            mode_counts = report["per_mode"].setdefault(
+                label_mode, {"labeled": 0, "correct": 0, "mismatches": 0}
+            )
+            for counts in (report, user_counts, mode_counts):
+                counts["labeled"] += 1
+            if label_mode == activity.get('transportation_mode'):
+                for counts in (report, user_counts, mode_counts):
+                    counts["correct"] += 1
+            else:
+                for counts in (report, user_counts, mode_counts):
+                    counts["mismatches"] += 1
+                if len(report["mismatch_samples"]) < max_mismatch_samples:
+                    report["mismatch_samples"].append({
+                        'user_id': user_id,
+                        'activity_id': activity['_id'],
+                        'db_mode': activity.get('transportation_mode'),
+                        'label_mode': label_mode
+                    })
+
+        self.print_verification_report(report)
+        return report
+
+    def get_labeled_activities(self, user_ids: List[str], sample_size: int = 0):
+        """
+        Stream the fields needed for verification of all activities of user_ids,
+        or of a random sample of sample_size of them.
+        """
+        projection = {
+            "user_id": 1,
+            "start_date_time": 1,
+            "end_date_time": 1,
+            "transportation_mode": 1
+        }
+        query = {"user_id": {"$in": user_ids}}
+        if sample_size > 0:
+            pipeline = [
+                {"$match": query},
+                {"$sample": {"size": sample_size}},
+                {"$project": projection}
+            ]
+            self.explain_aggregate('verify_sample', 'activities', pipeline)
+            return self.db.activities.aggregate(pipeline)
+        return self.db.activities.find(query, projection, batch_size=10000)
+
+    def explain_aggregate(self, name: str, collection: str, pipeline: List[Dict]):
+        """
+        With explain enabled, run the pipeline with explain("executionStats") and write
+        its execution stats to the metrics stream, like part2.py does for the queries.
+        """
+        if not self.explain:
+            return
+        command = {"aggregate": collection, "pipeline": pipeline, "cursor": {}}
+        for command, output in explain_commands(self.connection.client, [(self.db.name, command)]):
+            self.metrics.emit({
+                "event": "explain",
+                "query": name,
+                "command": command,
+                "docs_examined": sum_docs_examined(output),
+                "execution_stats": output.get("executionStats", output)
+            })
+
+    @staticmethod
+    def print_verification_report(report: Dict):
+        checked = "sampled activities" if report["sampled"] else "activities"
+        print(f"Verification complete. {report['correct']} out of {report['labeled']} {checked} "
+              f"with labels are correct ({report['total']} {checked} of labeled users checked).")
+
+        if report["per_mode"]:
+            rows = [[mode, counts["labeled"], counts["correct"], counts["mismatches"]]
+                    for mode, counts in sorted(report["per_mode"].items())]
+            print(tabulate(rows, headers=['Mode', 'Labeled', 'Correct', 'Mismatches']))
+
+        if report["mismatches"]:
+            print(f"\n{report['mismatches']} inconsistent activities found, "
+                  f"showing {len(report['mismatch_samples'])}:")
+            for activity in report["mismatch_samples"]:
+                print(f"User: {activity['user_id']}, Activity: {activity['activity_id']}, "
                       f"DB Mode: {activity['db_mode']}, Label Mode: {activity['label_mode']}")
         else:
             print("No inconsistencies found.")
 
-    def get_user_activities_with_transportation(self, user_id: str) -> List[Dict]:
-        return list(self.db.activities.find(
-            {"user_id": user_id},
-            {
-                "start_date_time": 1,
-                "end_date_time": 1,
-                "transportation_mode": 1
-            }
-        ))
+def program_from_env(metrics: Metrics) -> ActivityTrackerProgram:
+    return ActivityTrackerProgram(
+        batch_size=int(os.getenv('INGEST_BATCH_SIZE', 100)),
+        trackpoint_format=os.getenv('TRACKPOINT_FORMAT', 'array'),
+        metrics=metrics,
+        bucket_size=int(os.getenv('TRACKPOINT_BUCKET_SIZE', BUCKET_SIZE)),
+        explain=os.getenv('REPORT_EXPLAIN', '0') == '1'
+    )
+
+
+def update_labels_from_env(program: ActivityTrackerProgram, dataset_path: str, metrics: Metrics):
+    """
+    Set and verify the transportation modes with the LABEL_* and VERIFY_SAMPLE_SIZE
+    settings. Shared by main and the last job of a distributed ingest (ingest_jobs.py).
+    """
+    min_overlap = os.getenv('LABEL_MIN_OVERLAP')
+    min_overlap = float(min_overlap) if min_overlap else None
+    with metrics.phase('update_transportation_modes'):
+        program.update_transportation_modes(
+            dataset_path,
+            min_overlap=min_overlap,
+            segments=os.getenv('LABEL_SEGMENTS', '0') == '1'
+        )
+    with metrics.phase('verify_transportation_modes'):
+        program.verify_transportation_modes(
+            dataset_path,
+            sample_size=int(os.getenv('VERIFY_SAMPLE_SIZE', 0)),
+            min_overlap=min_overlap
+        )
+
 
 def main():
         program = None
+        metrics = Metrics.from_env()
         try:
-            program = ActivityTrackerProgram()
+            program = program_from_env(metrics)
             dataset_path = 'dataset'
 
-            program.drop_collections()
-            program.create_collections()
-            program.populate_user_table(dataset_path)
-            program.populate_activities(dataset_path)
+            if len(sys.argv) > 1 and sys.argv[1] == 'rebuild-rollups':
+                program.explain_aggregate('rebuild_rollups', 'activities', REBUILD_PIPELINE)
+                with metrics.phase('rebuild_rollups'):
+                    groups = rebuild_rollups(program.db)
+                bump_data_generation(program.db)
+                print(f"Rebuilt the rollups from {groups} (user, mode, year) groups")
+                return
+
+            if len(sys.argv) > 1 and sys.argv[1] == 'backfill-stats':
+                program.create_collections()
+                program.set_write_phase('ingest')
+                with metrics.phase('backfill_stats'):
+                    program.backfill_activity_stats()
+                program.set_write_phase('default')
+                bump_data_generation(program.db)
+                return
+
+            bulk = os.getenv('INGEST_BULK', '1') != '0'
+            incremental = os.getenv('INGEST_MODE', 'full') == 'incremental'
+
+            # Invalidate cached reports before the data starts changing, and again once
+            # it is complete, so no report computed from a partial ingest is served later
+            bump_data_generation(program.db)
+            with metrics.phase('prepare_collections'):
+                if not incremental:
+                    program.drop_collections()
+                program.create_collections()
+            program.set_write_phase('ingest')
+            with metrics.phase('populate_users'):
+                program.populate_user_table(dataset_path, bulk=bulk, incremental=incremental)
+            with metrics.phase('populate_activities'):
+                program.populate_activities(
+                    dataset_path,
+                    workers=int(os.getenv('INGEST_WORKERS', os.cpu_count() or 1)),
+                    bulk=bulk,
+                    incremental=incremental,
+                    parser=os.getenv('PLT_PARSER', 'numpy'),
+                    writers=int(os.getenv('INGEST_WRITERS', 2)),
+                    write_queue=int(os.getenv('INGEST_WRITE_QUEUE', 0)) or None
+                )
+            program.set_write_phase('default')
             
-            program.update_transportation_modes(dataset_path)
-            program.verify_transportation_modes(dataset_path)
+            update_labels_from_env(program, dataset_path, metrics)
+            bump_data_generation(program.db)
             
         except Exception as e:
+            metrics.incr('errors')
             print("ERROR: Failed to use database:", e)
         finally:
+            metrics.summary()
+            metrics.close()
             if program:
                 program.connection.close_connection()
                 
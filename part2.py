@@ -1,17 +1,150 @@
 import datetime
 import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+from pymongo import monitoring
+import numpy as np
 from DbConnector import DbConnector
 from tabulate import tabulate
-from haversine import haversine, Unit
+from instrumentation import Metrics
+from query_stats import QueryStatsListener, explain_commands, sum_docs_examined
+from report_cache import ReportCache, cached_report
+from rollups import USER_MODE_ROLLUP, USER_ROLLUP, YEAR_ROLLUP, rollups_ready
+from trackpoint_buckets import read_bucket_columns, with_activity_columns
+from trackpoint_codec import activity_columns, columns_to_trackpoint_docs
+from trajectory_stats import altitude_gain, distance_to_point_m, max_gap_seconds, path_length_km
+
+# Report queries in print order: (number, method computing the results, method printing them)
+QUERIES = [
+    ('1', 'get_dataset_counts', 'count_dataset_elements'),
+    ('2', 'get_average_activities_per_user', 'average_activities_per_user'),
+    ('3', 'get_top_20_users_by_activity_count', 'top_20_users_by_activity_count'),
+    ('4', 'get_users_who_took_taxi', 'users_who_took_taxi'),
+    ('5', 'get_transportation_mode_counts', 'count_transportation_modes'),
+    ('6', 'get_most_activities_and_hours', 'compare_most_activities_and_hours'),
+    ('7', 'get_total_walking_distance_2008_user112', 'calculate_total_walking_distance_2008_user112'),
+    ('8', 'get_top_20_users_by_altitude_gain', 'top_20_users_by_altitude_gain'),
+    ('9', 'count_invalid_activities_per_user', 'find_users_with_invalid_activities'),
+    ('10', 'get_users_in_forbidden_city', 'find_users_in_forbidden_city'),
+    ('11', 'get_users_most_used_transportation', 'find_users_most_used_transportation'),
+]
 
 class ActivityTrackerProgram:
-    def __init__(self):
+    def __init__(self, use_cache: bool = True, cache_size: int = 256, metrics: Metrics = None):
         self.connection = DbConnector()
         self.db = self.connection.db
-       
+        # Report results are cached until the next ingest bumps the data generation
+        self.report_cache = ReportCache(self.db, cache_size) if use_cache else None
+        self.metrics = metrics or Metrics()
+
+    def use_rollups(self) -> bool:
+        # Queries 1, 2, 3, 5, 6 and 11 read the rollup collections maintained by main.py
+        # when they are built, and aggregate over all activities otherwise
+        return rollups_ready(self.db)
+
     def print_query_results(self, results, headers):
         print(tabulate(results, headers=headers, tablefmt='psql'))
         print()  # Add a blank line for readability
+
+    def run_queries(self, query_ids: List[str] = None, concurrency: int = 4,
+                    stats_listener: QueryStatsListener = None, explain: bool = False) -> List[Dict]:
+        """
+        Computes the selected report queries (all of them by default) on a pool of
+        concurrency threads and prints each result in query order as soon as it and
+        the queries before it are done.
+        Returns the wall-clock seconds of every query. With a registered stats_listener
+        it also holds the commands, documents and bytes returned per query, and with
+        explain the documents examined, found by re-running the commands with explain.
+        Every query and explain output is also written to the metrics stream.
+        """
+        selected = [query for query in QUERIES if query_ids is None or query[0] in query_ids]
+        metrics = []
+
+        with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+            futures = [executor.submit(self.run_timed_query, query_id, compute_name, stats_listener)
+                       for query_id, compute_name, _ in selected]
+
+            for (query_id, _, print_name), future in zip(selected, futures):
+                results, error, query_metrics = future.result()
+                self.metrics.incr('queries')
+                if error is not None:
+                    self.metrics.incr('errors')
+                    query_metrics["error"] = str(error)
+                    print(f"\n{query_id}. failed: {error}\n")
+                else:
+                    getattr(self, print_name)(results=results)
+                metrics.append(query_metrics)
+
+        if explain and stats_listener:
+            for query_metrics in metrics:
+                explained = explain_commands(self.connection.client, query_metrics.pop("explainable", []))
+                query_metrics["docs_examined"] = sum(sum_docs_examined(output) for _, output in explained)
+                for command, output in explained:
+                    self.metrics.emit({
+                        "event": "explain",
+                        "query": query_metrics["query"],
+                        "command": command,
+                        "execution_stats": output.get("executionStats", output)
+                    })
+        for query_metrics in metrics:
+            query_metrics.pop("explainable", None)
+            self.metrics.incr('docs_returned', query_metrics.get("docs_returned", 0))
+            self.metrics.incr('bytes_returned', query_metrics.get("bytes_returned", 0))
+            self.metrics.emit({"event": "query", **query_metrics})
+        return metrics
+
+    def run_timed_query(self, query_id: str, compute_name: str, stats_listener: QueryStatsListener = None):
+        if stats_listener:
+            stats_listener.start_query(query_id)
+        results, error = None, None
+        start = time.perf_counter()
+        try:
+            results = getattr(self, compute_name)()
+        except Exception as e:
+            error = e
+        query_metrics = {"query": query_id, "seconds": round(time.perf_counter() - start, 4)}
+        if stats_listener:
+            query_metrics.update(stats_listener.end_query() or {})
+        return results, error, query_metrics
+
+    def print_query_metrics(self, metrics: List[Dict]):
+        headers = ['Query', 'Seconds', 'Commands', 'Docs Returned', 'Bytes Returned', 'Docs Examined']
+        keys = ['query', 'seconds', 'commands', 'docs_returned', 'bytes_returned', 'docs_examined']
+        print("Query timings:")
+        self.print_query_results([[m.get(key) for key in keys] for m in metrics], headers)
+
+    def iter_activity_columns(self, query: Dict, fields: List[str], extra_fields: Dict = None,
+                              batch_size: int = None, sort: List[Tuple] = None):
+        """
+        Yields (activity, columns) for every activity matching query, where columns holds
+        the requested trackpoint fields as NumPy arrays. Works for the embedded
+        'trackpoints' array, the packed 'trackpoint_columns' and the trackpoint_buckets
+        collection, and only fetches the requested fields of each.
+        """
+        projection = {"user_id": 1, "bucket_count": 1, **(extra_fields or {})}
+        for field in fields:
+            projection[f"trackpoints.{field}"] = 1
+            projection[f"trackpoint_columns.{field}"] = 1
+        if 'date_time' in fields:
+            projection["trackpoint_columns.start"] = 1
+        cursor = self.db.activities.find(query, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        yield from with_activity_columns(self.db.trackpoint_buckets, cursor, fields, batch_size or 100)
+
+    def iter_activities_without_stats(self, query: Dict, fields: List[str], extra_fields: Dict = None,
+                                      batch_size: int = None):
+        """
+        Like iter_activity_columns, but only for activities that were ingested without the
+        precomputed trackpoint statistics (see backfill-stats in main.py).
+        """
+        query = {**query, "trackpoint_count": {"$exists": False}}
+        return self.iter_activity_columns(query, fields, extra_fields, batch_size)
         
     def print_multiple_documents_as_json(self, collection_name: str, trackpoint_limit=10, document_limit=5):
         """
@@ -22,50 +155,100 @@ class ActivityTrackerProgram:
         trackpoint_limit (int): The number of trackpoints to display if present.
         document_limit (int): The number of documents to display.
         """
-        documents = self.db[collection_name].find().limit(document_limit)
-        if documents:
-            print(f"\n{document_limit} documents from collection '{collection_name}':")
-            for i, document in enumerate(documents):
-                print(f"\nDocument {i + 1}:")
-                # Limit the number of trackpoints in the document, if present
-                if 'trackpoints' in document:
-                    document['trackpoints'] = document['trackpoints'][:trackpoint_limit]
-                    print(f"Showing only the first {trackpoint_limit} trackpoints...")
-                # Pretty print JSON
-                print(json.dumps(document, indent=4, default=str)) # Pretty print JSON
-                
-        else:
+        # Cut the trackpoint arrays on the server, the packed columns can only be decoded whole.
+        # A $slice alone returns every other field, so the geometry has to be left out explicitly
+        documents = self.db[collection_name].find(
+            {}, {"geometry": 0, "trackpoints": {"$slice": trackpoint_limit},
+                 "mode_segments": {"$slice": trackpoint_limit}}
+        ).limit(document_limit)
+        i = -1
+        print(f"\n{document_limit} documents from collection '{collection_name}':")
+        for i, document in enumerate(documents):
+            print(f"\nDocument {i + 1}:")
+            # Limit the number of trackpoints in the document, if present
+            if 'trackpoint_columns' in document:
+                document['trackpoints'] = columns_to_trackpoint_docs(
+                    activity_columns(document), trackpoint_limit
+                )
+                del document['trackpoint_columns']
+            elif 'bucket_count' in document:
+                # The first bucket holds the first trackpoints
+                columns = read_bucket_columns(self.db.trackpoint_buckets, [document['_id']], max_seq=0)
+                document['trackpoints'] = columns_to_trackpoint_docs(
+                    columns.get(document['_id'], {}), trackpoint_limit
+                )
+            if 'trackpoints' in document:
+                document['trackpoints'] = document['trackpoints'][:trackpoint_limit]
+                print(f"Showing only the first {trackpoint_limit} trackpoints...")
+            # Pretty print JSON
+            print(json.dumps(document, indent=4, default=str)) # Pretty print JSON
+
+        if i < 0:
             print(f"No documents found in collection '{collection_name}'.")
-        
+    
 
     # 1. Dataset counts
-    def count_dataset_elements(self):
+    @cached_report
+    def get_dataset_counts(self) -> List[List]:
         user_count = self.db.users.count_documents({})
+        if self.use_rollups():
+            totals = list(self.db[USER_ROLLUP].aggregate([
+                {"$group": {"_id": None, "activities": {"$sum": "$activities"},
+                            "trackpoints": {"$sum": "$trackpoints"}}}
+            ]))
+            totals = totals[0] if totals else {"activities": 0, "trackpoints": 0}
+            return [[user_count, totals['activities'], totals['trackpoints']]]
+
         activity_count = self.db.activities.count_documents({})
         trackpoint_count = self.db.activities.aggregate([
-            {"$project": {"trackpoint_count": {"$size": "$trackpoints"}}},
+            {"$project": {"trackpoint_count": {"$ifNull": [
+                "$trackpoint_count",
+                "$trackpoint_columns.count",
+                {"$size": {"$ifNull": ["$trackpoints", []]}}
+            ]}}},
             {"$group": {"_id": None, "total": {"$sum": "$trackpoint_count"}}}
         ]).next()['total']
 
-        results = [[user_count, activity_count, trackpoint_count]]
+        return [[user_count, activity_count, trackpoint_count]]
+
+    def count_dataset_elements(self, results=None):
+        results = results if results is not None else self.get_dataset_counts()
         headers = ['Users', 'Activities', 'Trackpoints']
         print("1. Dataset counts:")
         self.print_query_results(results, headers)
 
     # 2. Average activities per user
-    def average_activities_per_user(self):
+    @cached_report
+    def get_average_activities_per_user(self) -> List[List]:
+        if self.use_rollups():
+            result = self.db[USER_ROLLUP].aggregate([
+                {"$match": {"activities": {"$gt": 0}}},
+                {"$group": {"_id": None, "avg_activities": {"$avg": "$activities"}}}
+            ]).next()
+            return [[round(result['avg_activities'], 2)]]
+
         result = self.db.activities.aggregate([
             {"$group": {"_id": "$user_id", "activity_count": {"$sum": 1}}},
             {"$group": {"_id": None, "avg_activities": {"$avg": "$activity_count"}}}
         ]).next()
         
-        results = [[round(result['avg_activities'], 2)]]
+        return [[round(result['avg_activities'], 2)]]
+
+    def average_activities_per_user(self, results=None):
+        results = results if results is not None else self.get_average_activities_per_user()
         headers = ['Average Activities per User']
         print("2. Average number of activities per user:")
         self.print_query_results(results, headers)
 
     # 3. Top 20 users with highest activity count
-    def top_20_users_by_activity_count(self):
+    @cached_report
+    def get_top_20_users_by_activity_count(self) -> List[List]:
+        if self.use_rollups():
+            results = self.db[USER_ROLLUP].find({"activities": {"$gt": 0}}, {"activities": 1}).sort(
+                [("activities", -1), ("_id", 1)]
+            ).limit(20)
+            return [[r['_id'], r['activities']] for r in results]
+
         results = list(self.db.activities.aggregate([
             {"$group": {"_id": "$user_id", "activity_count": {"$sum": 1}}},
             {"$sort": {"activity_count": -1}},
@@ -73,25 +256,40 @@ class ActivityTrackerProgram:
             {"$project": {"_id": 0, "user_id": "$_id", "activity_count": 1}}
         ]))
         
-        formatted_results = [[r['user_id'], r['activity_count']] for r in results]
+        return [[r['user_id'], r['activity_count']] for r in results]
+
+    def top_20_users_by_activity_count(self, results=None):
+        formatted_results = results if results is not None else self.get_top_20_users_by_activity_count()
         headers = ['User ID', 'Activity Count']
         print("3. Top 20 users with the highest number of activities:")
         self.print_query_results(formatted_results, headers)
 
     # 4. Users who have taken a taxi
-    def users_who_took_taxi(self):
-
+    @cached_report
+    def get_users_who_took_taxi(self) -> List[List]:
         results = list(self.db.activities.distinct(
             "user_id",
             {"transportation_mode": "taxi"}
         ))
-        formatted_results = [[user_id] for user_id in sorted(results)]
+        return [[user_id] for user_id in sorted(results)]
+
+    def users_who_took_taxi(self, results=None):
+        formatted_results = results if results is not None else self.get_users_who_took_taxi()
         headers = ['User ID']
         print("4. Users who have taken a taxi:")
         self.print_query_results(formatted_results, headers)
 
     # 5. Count of activities for each transportation mode
-    def count_transportation_modes(self):
+    @cached_report
+    def get_transportation_mode_counts(self) -> List[List]:
+        if self.use_rollups():
+            results = list(self.db[USER_MODE_ROLLUP].aggregate([
+                {"$match": {"_id.transportation_mode": {"$ne": None}, "activities": {"$gt": 0}}},
+                {"$group": {"_id": "$_id.transportation_mode", "activity_count": {"$sum": "$activities"}}},
+                {"$sort": {"activity_count": -1}}
+            ]))
+            return [[r['_id'], r['activity_count']] for r in results]
+
         results = list(self.db.activities.aggregate([
             {"$match": {"transportation_mode": {"$ne": None}}},
             {"$group": {
@@ -101,13 +299,26 @@ class ActivityTrackerProgram:
             {"$sort": {"activity_count": -1}}
         ]))
         
-        formatted_results = [[r['_id'], r['activity_count']] for r in results]
+        return [[r['_id'], r['activity_count']] for r in results]
+
+    def count_transportation_modes(self, results=None):
+        formatted_results = results if results is not None else self.get_transportation_mode_counts()
         headers = ['Transportation Mode', 'Activity Count']
         print("5. Count of activities for each transportation mode (excluding null):")
         self.print_query_results(formatted_results, headers)
 
     # 6. Year comparisons
-    def compare_most_activities_and_hours(self):
+    @cached_report
+    def get_most_activities_and_hours(self) -> Dict[str, List[List]]:
+        if self.use_rollups():
+            years = self.db[YEAR_ROLLUP]
+            activities_by_year = years.find({"activities": {"$gt": 0}}).sort("activities", -1).limit(1)
+            hours_by_year = years.find({"activities": {"$gt": 0}}).sort("seconds", -1).limit(1)
+            return {
+                "activities": [[r['_id'], r['activities']] for r in activities_by_year],
+                "hours": [[r['_id'], round(r['seconds'] / 3600, 2)] for r in hours_by_year]
+            }
+
         # Year with most activities
         activities_by_year = list(self.db.activities.aggregate([
             {"$group": {
@@ -137,19 +348,27 @@ class ActivityTrackerProgram:
             {"$limit": 1}
         ]))
 
+        return {
+            "activities": [[r['_id'], r['activity_count']] for r in activities_by_year],
+            "hours": [[r['_id'], round(r['total_hours'], 2)] for r in hours_by_year]
+        }
+
+    def compare_most_activities_and_hours(self, results=None):
+        results = results if results is not None else self.get_most_activities_and_hours()
+
         # Print results for 6a
-        activities_results = [[r['_id'], r['activity_count']] for r in activities_by_year]
+        activities_results = results["activities"]
         print("6a. Year with the most activities:")
         self.print_query_results(activities_results, ['Year', 'Activity Count'])
 
         # Print results for 6b
-        hours_results = [[r['_id'], round(r['total_hours'], 2)] for r in hours_by_year]
+        hours_results = results["hours"]
         print("6b. Year with the most recorded hours:")
         self.print_query_results(hours_results, ['Year', 'Total Recorded Hours'])
 
         # Compare years
-        activities_year = activities_by_year[0]['_id']
-        hours_year = hours_by_year[0]['_id']
+        activities_year = activities_results[0][0]
+        hours_year = hours_results[0][0]
         
         if activities_year == hours_year:
             print(f"The year with the most activities ({activities_year}) "
@@ -158,164 +377,249 @@ class ActivityTrackerProgram:
             print(f"The year with the most activities ({activities_year}) "
                   f"is different from the year with the most recorded hours ({hours_year}).")
 
+    @staticmethod
+    def build_activity_filter(user_id=None, transportation_mode=None, start=None, end=None) -> Dict:
+        """
+        Filter on user, transportation mode and a [start, end) range of start_date_time.
+        Arguments left as None are not filtered on.
+        """
+        query = {}
+        if user_id is not None:
+            query["user_id"] = user_id
+        if transportation_mode is not None:
+            query["transportation_mode"] = transportation_mode
+        if start is not None or end is not None:
+            query["start_date_time"] = {}
+            if start is not None:
+                query["start_date_time"]["$gte"] = start
+            if end is not None:
+                query["start_date_time"]["$lt"] = end
+        return query
+
+    def calculate_total_distance(self, user_id=None, transportation_mode=None, start=None, end=None,
+                                 group_by: str = None):
+        """
+        Total distance in km of the matching activities, summed from their precomputed
+        distance_km. Activities without it get the haversine computed over their
+        lat/lon as NumPy arrays.
+        With group_by set to a field such as 'user_id' or 'transportation_mode', returns
+        a dict with the distance per value of that field instead of a single total.
+        """
+        query = self.build_activity_filter(user_id, transportation_mode, start, end)
+        extra_fields = {group_by: 1} if group_by else None
+
+        distances = {}
+        for r in self.db.activities.aggregate([
+            {"$match": {**query, "distance_km": {"$exists": True}}},
+            {"$group": {"_id": f"${group_by}" if group_by else None, "distance": {"$sum": "$distance_km"}}}
+        ]):
+            distances[r["_id"]] = r["distance"]
+
+        for activity, columns in self.iter_activities_without_stats(query, ['lat', 'lon'], extra_fields):
+            key = activity.get(group_by) if group_by else None
+            distances[key] = distances.get(key, 0.0) + path_length_km(columns['lat'], columns['lon'])
+
+        if group_by:
+            return distances
+        return distances.get(None, 0.0)
+
     # 7. Total walking distance for user 112 in 2008
-    def calculate_total_walking_distance_2008_user112(self):
-        activities = list(self.db.activities.find({
-            "user_id": "112",
-            "transportation_mode": "walk",
-            "start_date_time": {
-                "$gte": datetime.datetime(2008, 1, 1),
-                "$lt": datetime.datetime(2009, 1, 1)
-            }
-        }))
+    @cached_report
+    def get_total_walking_distance_2008_user112(self) -> float:
+        return self.calculate_total_distance(
+            user_id="112",
+            transportation_mode="walk",
+            start=datetime.datetime(2008, 1, 1),
+            end=datetime.datetime(2009, 1, 1)
+        )
 
-        total_distance = 0
-        for activity in activities:
-            trackpoints = activity['trackpoints']
-            for i in range(len(trackpoints) - 1):
-                point1 = (trackpoints[i]['lat'], trackpoints[i]['lon'])
-                point2 = (trackpoints[i + 1]['lat'], trackpoints[i + 1]['lon'])
-                distance = haversine(point1, point2, unit=Unit.KILOMETERS)
-                total_distance += distance
+    def calculate_total_walking_distance_2008_user112(self, results=None):
+        total_distance = results if results is not None else self.get_total_walking_distance_2008_user112()
 
         print("\n7. Total distance walked in 2008 by user with id=112:")
         print(f"   {total_distance:.2f} km")
 
-    def top_20_users_by_altitude_gain(self):
-        results = list(self.db.activities.aggregate([
-            # Unwind trackpoints to get individual points
-            {"$unwind": "$trackpoints"},
-            
-            # Filter out invalid altitudes (-777 is invalid)
-            {"$match": {
-                "trackpoints.altitude": {"$ne": -777}
-            }},
-            
-            # Group by user and activity to calculate gains within each activity
-            {"$group": {
-                "_id": {
-                    "user_id": "$user_id",
-                    "activity_id": "$_id"
-                },
-                "trackpoints": {  
-                    "$push": "$trackpoints.altitude"
-                }
-            }},
-            
-            # Calculate altitude gains between consecutive points
-            {"$project": {
-                "user_id": "$_id.user_id",
-                "altitude_gains": {
-                    "$reduce": {
-                        "input": {"$range": [1, {"$size": "$trackpoints"}]}, 
-                        "initialValue": 0,
-                        "in": {
-                            "$cond": {
-                                "if": {
-                                    "$gt": [
-                                        {"$subtract": [
-                                            {"$arrayElemAt": ["$trackpoints", "$$this"]},
-                                            {"$arrayElemAt": ["$trackpoints", {"$subtract": ["$$this", 1]}]}
-                                        ]},
-                                        0
-                                    ]
-                                },
-                                "then": {
-                                    "$add": [
-                                        "$$value",
-                                        {"$subtract": [
-                                            {"$arrayElemAt": ["$trackpoints", "$$this"]},
-                                            {"$arrayElemAt": ["$trackpoints", {"$subtract": ["$$this", 1]}]}
-                                        ]}
-                                    ]
-                                },
-                                "else": "$$value"
-                            }
-                        }
-                    }
-                }
-            }},
-            
-            # Group by user to sum up all altitude gains
-            {"$group": {
-                "_id": "$user_id",
-                "total_gain": {"$sum": "$altitude_gains"}
-            }},
-            
-            # Sort by total gain in descending order
-            {"$sort": {"total_gain": -1}},
-            
-            # Get top 20 users
-            {"$limit": 20}
-        ]))
+    # 8. Top 20 users by altitude gain
+    @cached_report
+    def get_top_20_users_by_altitude_gain(self) -> List[List]:
+        # Sum the precomputed gains (feet, -777 altitudes left out) per user
+        results = self.db.activities.aggregate([
+            {"$match": {"altitude_gain_ft": {"$exists": True}}},
+            {"$group": {"_id": "$user_id", "total_gain": {"$sum": "$altitude_gain_ft"}}}
+        ])
+        user_gains = {r["_id"]: r["total_gain"] for r in results}
+
+        for activity, columns in self.iter_activities_without_stats({}, ['altitude']):
+            user_gains[activity['user_id']] = (
+                user_gains.get(activity['user_id'], 0) + altitude_gain(columns['altitude'])
+            )
+
+        # Sort by total gain in descending order and get top 20 users
+        top_users = sorted(user_gains.items(), key=lambda x: x[1], reverse=True)[:20]
 
         # Convert altitude gains from feet to meters and format results
-        converted_results = [
-            (r["_id"], round(r["total_gain"] * 0.3048, 2))
-            for r in results
+        return [
+            [user_id, round(total_gain * 0.3048, 2)]
+            for user_id, total_gain in top_users
         ]
-        
+
+    def top_20_users_by_altitude_gain(self, results=None):
+        converted_results = results if results is not None else self.get_top_20_users_by_altitude_gain()
+
         headers = ['User ID', 'Total Meters Gained']
         print("\n8. Top 20 users who have gained the most altitude meters:")
         self.print_query_results(converted_results, headers)
 
-    
-    # 9. Users with invalid activities
-    def find_users_with_invalid_activities(self):
-        invalid_activities = []
-        
-        activities = self.db.activities.find({})
-        for activity in activities:
-            trackpoints = activity['trackpoints']
-            is_invalid = False
-            
-            for i in range(len(trackpoints) - 1):
-                time1 = trackpoints[i]['date_time']
-                time2 = trackpoints[i + 1]['date_time']
-                time_diff = (time2 - time1).total_seconds() / 60
-                
-                if time_diff >= 5:
-                    is_invalid = True
-                    break
-            
-            if is_invalid:
-                invalid_activities.append(activity['user_id'])
-
-        # Count invalid activities per user
+    @cached_report
+    def count_invalid_activities_per_user(self, gap_minutes: float = 5) -> Dict[str, int]:
+        """
+        Number of activities per user with two consecutive trackpoints gap_minutes or more
+        apart. The gaps are found inside MongoDB: from max_gap_seconds where it was
+        precomputed, otherwise by comparing consecutive trackpoints.date_time in an
+        aggregation. Only activities in the columnar format without statistics are
+        checked in Python, and for those only the timestamps are fetched.
+        """
+        gap_seconds = gap_minutes * 60
         user_counts = {}
-        for user_id in invalid_activities:
-            user_counts[user_id] = user_counts.get(user_id, 0) + 1
+
+        precomputed = self.db.activities.aggregate([
+            {"$match": {"max_gap_seconds": {"$gte": gap_seconds}}},
+            {"$group": {"_id": "$user_id", "count": {"$sum": 1}}}
+        ])
+
+        # Activities in the array format without statistics: compare consecutive timestamps
+        # (date differences are in milliseconds) without sending any trackpoint to the client
+        embedded = self.db.activities.aggregate([
+            {"$match": {"trackpoint_count": {"$exists": False}, "trackpoints.1": {"$exists": True}}},
+            {"$project": {"user_id": 1, "times": "$trackpoints.date_time"}},
+            {"$match": {"$expr": {"$anyElementTrue": [{"$map": {
+                "input": {"$range": [1, {"$size": "$times"}]},
+                "as": "i",
+                "in": {"$gte": [
+                    {"$subtract": [
+                        {"$arrayElemAt": ["$times", "$$i"]},
+                        {"$arrayElemAt": ["$times", {"$subtract": ["$$i", 1]}]}
+                    ]},
+                    gap_seconds * 1000
+                ]}
+            }}]}}},
+            {"$group": {"_id": "$user_id", "count": {"$sum": 1}}}
+        ])
+
+        for r in list(precomputed) + list(embedded):
+            user_counts[r["_id"]] = user_counts.get(r["_id"], 0) + r["count"]
+
+        columnar = self.iter_activities_without_stats(
+            {"trackpoint_columns": {"$exists": True}}, ['date_time'], batch_size=1000
+        )
+        for activity, columns in columnar:
+            if max_gap_seconds(columns['date_time']) >= gap_seconds:
+                user_counts[activity['user_id']] = user_counts.get(activity['user_id'], 0) + 1
+
+        return user_counts
+
+    # 9. Users with invalid activities
+    def find_users_with_invalid_activities(self, gap_minutes: float = 5, results=None):
+        user_counts = results if results is not None else self.count_invalid_activities_per_user(gap_minutes)
 
         formatted_results = [[user_id, count] for user_id, count in 
                            sorted(user_counts.items(), key=lambda x: x[1], reverse=True)]
         
         headers = ['User ID', 'Invalid Activity Count']
-        print("\n9. Users with invalid activities and their count:")
+        print(f"\n9. Users with invalid activities (trackpoints {gap_minutes} minutes or more apart) and their count:")
         self.print_query_results(formatted_results, headers)
 
+    def iter_geo_candidates(self, geo_query: Dict, query: Dict, fields: List[str]):
+        """
+        Yields (activity, columns) for the activities whose geometry matches geo_query,
+        plus every activity that has no geometry yet (see backfill-stats in main.py),
+        so the caller can run the exact check on the trackpoints of the candidates only.
+        Bucketed activities are matched through the geometry of their buckets.
+        """
+        yield from self.iter_activity_columns({**query, "geometry": geo_query}, fields)
+        buckets = self.db.trackpoint_buckets
+        bucketed_ids = {bucket["activity_id"] for bucket in buckets.find({**query, "geometry": geo_query},
+                                                                         {"activity_id": 1})}
+        bucketed_ids.update(buckets.distinct("activity_id", {**query, "geometry": {"$exists": False}}))
+        if bucketed_ids:
+            yield from self.iter_activity_columns(
+                {**query, "_id": {"$in": sorted(bucketed_ids)}, "geometry": {"$exists": False}}, fields
+            )
+        yield from self.iter_activity_columns(
+            {**query, "geometry": {"$exists": False}, "bucket_count": {"$exists": False}}, fields
+        )
+
+    @cached_report
+    def users_near(self, lat: float, lon: float, radius_m: float,
+                   time_range: Tuple[datetime.datetime, datetime.datetime] = None) -> List[str]:
+        """
+        Users with a trackpoint within radius_m meters of (lat, lon), optionally only
+        counting trackpoints inside time_range = (start, end). Candidate activities are
+        found through the 2dsphere index on their geometry, and only their trackpoints
+        are checked exactly.
+        """
+        query = {}
+        fields = ['lat', 'lon']
+        if time_range:
+            start, end = time_range
+            query = {"start_date_time": {"$lte": end}, "end_date_time": {"$gte": start}}
+            fields.append('date_time')
+
+        geo_query = {"$nearSphere": {
+            "$geometry": {"type": "Point", "coordinates": [lon, lat]},
+            "$maxDistance": radius_m
+        }}
+        user_ids = set()
+        for activity, columns in self.iter_geo_candidates(geo_query, query, fields):
+            if activity['user_id'] in user_ids:
+                continue
+            near = distance_to_point_m(columns['lat'], columns['lon'], lat, lon) <= radius_m
+            if time_range:
+                times = columns['date_time']
+                near &= (times >= np.datetime64(start, 's')) & (times <= np.datetime64(end, 's'))
+            if near.any():
+                user_ids.add(activity['user_id'])
+        return sorted(user_ids)
+
     # 10. Users who have tracked activity in the Forbidden City
-    def find_users_in_forbidden_city(self):
-        results = list(self.db.activities.aggregate([
-            {"$unwind": "$trackpoints"},
-            {"$match": {
-                "$expr": {
-                    "$and": [
-                        {"$eq": [{"$round": ["$trackpoints.lat", 3]}, 39.916]},
-                        {"$eq": [{"$round": ["$trackpoints.lon", 3]}, 116.397]}
-                    ]
-                }
-            }},
-            {"$group": {"_id": "$user_id"}},
-            {"$sort": {"_id": 1}}
-        ]))
+    @cached_report
+    def get_users_in_forbidden_city(self) -> List[List]:
+        # A trackpoint is in the Forbidden City if it rounds to (39.916, 116.397). The
+        # index narrows the activities down to those whose path crosses a slightly padded
+        # box around that cell, the exact check is done on their trackpoints.
+        lat, lon, half_cell, pad = 39.916, 116.397, 0.0005, 0.0001
+        south, north = lat - half_cell - pad, lat + half_cell + pad
+        west, east = lon - half_cell - pad, lon + half_cell + pad
+        geo_query = {"$geoIntersects": {"$geometry": {
+            "type": "Polygon",
+            "coordinates": [[[west, south], [east, south], [east, north], [west, north], [west, south]]]
+        }}}
+
+        user_ids = set()
+        for activity, columns in self.iter_geo_candidates(geo_query, {}, ['lat', 'lon']):
+            if ((np.round(columns['lat'], 3) == lat) & (np.round(columns['lon'], 3) == lon)).any():
+                user_ids.add(activity['user_id'])
+
+        return [[user_id] for user_id in sorted(user_ids)]
 
-        formatted_results = [[r['_id']] for r in results]
+    def find_users_in_forbidden_city(self, results=None):
+        formatted_results = results if results is not None else self.get_users_in_forbidden_city()
         headers = ['User ID']
         print("\n10. Users who have tracked an activity in the Forbidden City of Beijing:")
         self.print_query_results(formatted_results, headers)
 
     # 11. Users' most used transportation mode
-    def find_users_most_used_transportation(self):
+    @cached_report
+    def get_users_most_used_transportation(self) -> List[List]:
+        if self.use_rollups():
+            results = list(self.db[USER_MODE_ROLLUP].aggregate([
+                {"$match": {"_id.transportation_mode": {"$ne": None}, "activities": {"$gt": 0}}},
+                {"$sort": {"activities": -1}},
+                {"$group": {"_id": "$_id.user_id", "most_used_mode": {"$first": "$_id.transportation_mode"}}},
+                {"$sort": {"_id": 1}}
+            ]))
+            return [[r['_id'], r['most_used_mode']] for r in results]
+
         results = list(self.db.activities.aggregate([
             {"$match": {"transportation_mode": {"$ne": None}}},
             {"$group": {
@@ -333,7 +637,10 @@ class ActivityTrackerProgram:
             {"$sort": {"_id": 1}}
         ]))
 
-        formatted_results = [[r['_id'], r['most_used_mode']] for r in results]
+        return [[r['_id'], r['most_used_mode']] for r in results]
+
+    def find_users_most_used_transportation(self, results=None):
+        formatted_results = results if results is not None else self.get_users_most_used_transportation()
         headers = ['User ID', 'Most Used Transportation Mode']
         print("\n11. Users with registered transportation_mode and their most used mode:")
         self.print_query_results(formatted_results, headers)
@@ -341,25 +648,34 @@ class ActivityTrackerProgram:
     
 def main():
     program = None
+    metrics = Metrics.from_env()
     try:
-        program = ActivityTrackerProgram()
-        program.count_dataset_elements()
-        program.average_activities_per_user()
-        program.top_20_users_by_activity_count()
-        program.users_who_took_taxi()
-        program.count_transportation_modes()
-        program.compare_most_activities_and_hours()
-        program.calculate_total_walking_distance_2008_user112()
-        program.top_20_users_by_altitude_gain()
-        program.find_users_with_invalid_activities()
-        program.find_users_in_forbidden_city()
-        program.find_users_most_used_transportation()
+        # The listener has to be registered before the client is created
+        stats_listener = QueryStatsListener()
+        monitoring.register(stats_listener)
+        program = ActivityTrackerProgram(
+            use_cache=os.getenv('REPORT_CACHE', '1') != '0',
+            cache_size=int(os.getenv('REPORT_CACHE_SIZE', 256)),
+            metrics=metrics
+        )
+        # Optionally select queries by number, e.g. `python part2.py 1 8 9`
+        with metrics.phase('queries'):
+            query_metrics = program.run_queries(
+                sys.argv[1:] or None,
+                concurrency=int(os.getenv('REPORT_CONCURRENCY', 4)),
+                stats_listener=stats_listener,
+                explain=os.getenv('REPORT_EXPLAIN', '0') == '1'
+            )
+        program.print_query_metrics(query_metrics)
         program.print_multiple_documents_as_json('activities', trackpoint_limit=3)
         program.print_multiple_documents_as_json('users')
         
     except Exception as e:
+        metrics.incr('errors')
         print("An error occurred:", e)
     finally:
+        metrics.summary()
+        metrics.close()
         if program:
             program.connection.close_connection()
 
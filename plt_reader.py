@@ -0,0 +1,155 @@
+import datetime
+import io
+from itertools import repeat
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Every .plt file starts with six header lines before the trackpoints
+HEADER_LINES = 6
+MAX_TRACKPOINTS = 2500
+# Trackpoint parsers selectable with read_plt_file(parser=...)
+PLT_PARSERS = ('python', 'numpy')
+# The date and time columns end every line as 'YYYY-MM-DD,HH:MM:SS'
+TIMESTAMP_WIDTH = 19
+TIMESTAMP_SEPARATORS = {4: b'-', 7: b'-', 10: b',', 13: b':', 16: b':'}
+
+
+def parse_timestamp(date: str, time: str) -> datetime.datetime:
+    """
+    Decode the fixed 'YYYY-MM-DD' and 'HH:MM:SS' columns of a .plt line.
+    Slicing is several times cheaper than strptime, which is only used as a
+    fallback for fields that do not have the fixed width.
+    """
+    if len(date) == 10 and len(time) == 8:
+        return datetime.datetime(
+            int(date[0:4]), int(date[5:7]), int(date[8:10]),
+            int(time[0:2]), int(time[3:5]), int(time[6:8])
+        )
+    return datetime.datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M:%S")
+
+
+def count_trackpoint_lines(data: bytes) -> int:
+    """
+    Count the lines after the header without decoding or splitting the file.
+    """
+    lines = data.count(b'\n')
+    if data and not data.endswith(b'\n'):
+        lines += 1
+    return max(lines - HEADER_LINES, 0)
+
+
+def parse_trackpoints(lines: List[str], activity_id: int, file_path: str,
+                      verbose: bool = True) -> List[tuple]:
+    """
+    Parse trackpoint lines one by one, skipping short lines and reporting bad ones.
+    """
+    trackpoints = []
+    for line_num, line in enumerate(lines, start=HEADER_LINES + 1):
+        parts = line.strip().split(',')
+        if len(parts) < 7:
+            continue
+        try:
+            lat, lon = float(parts[0]), float(parts[1])
+            altitude = int(float(parts[3]))
+            date_days = float(parts[4])
+            date_time = parse_timestamp(parts[5], parts[6])
+        except Exception as e:
+            if verbose:
+                print(f"Error processing line {line_num} in file {file_path}: {e}")
+            continue
+        trackpoints.append((activity_id, lat, lon, altitude, date_days, date_time))
+    return trackpoints
+
+
+def parse_trackpoints_numpy(lines: List[str], activity_id: int) -> Optional[List[tuple]]:
+    """
+    Vectorized parse_trackpoints for lines in the standard layout. The numeric columns
+    are converted by one np.loadtxt call and the fixed-width timestamps as a byte matrix
+    cast to datetime64. Gives the same tuples as parse_trackpoints, or None if any line
+    deviates from the layout, in which case the caller falls back to parse_trackpoints.
+    """
+    lines = [line.strip() for line in lines]
+    lines = [line for line in lines if line]
+    if not lines:
+        return []
+    body = '\n'.join(lines)
+    # Exactly seven fields on every line
+    if body.count(',') != 6 * len(lines):
+        return None
+    try:
+        values = np.loadtxt(io.StringIO(body), delimiter=',', usecols=(0, 1, 3, 4),
+                            comments=None, ndmin=2)
+        stamps = np.array([line[-TIMESTAMP_WIDTH:] for line in lines], dtype=f'S{TIMESTAMP_WIDTH}')
+    except (ValueError, UnicodeEncodeError):
+        return None
+    if values.shape[0] != len(lines) or not np.isfinite(values).all():
+        return None
+
+    stamps = stamps.view(np.uint8).reshape(-1, TIMESTAMP_WIDTH).copy()
+    separators = list(TIMESTAMP_SEPARATORS)
+    digits = [i for i in range(TIMESTAMP_WIDTH) if i not in TIMESTAMP_SEPARATORS]
+    expected = np.frombuffer(b''.join(TIMESTAMP_SEPARATORS.values()), dtype=np.uint8)
+    if not ((stamps[:, separators] == expected).all()
+            and ((stamps[:, digits] >= ord('0')) & (stamps[:, digits] <= ord('9'))).all()):
+        return None
+    stamps[:, 10] = ord('T')
+    try:
+        date_time = stamps.view(f'S{TIMESTAMP_WIDTH}').ravel().astype('datetime64[s]')
+    except ValueError:
+        return None
+
+    return list(zip(
+        repeat(activity_id),
+        values[:, 0].tolist(),
+        values[:, 1].tolist(),
+        # int() of the float, which truncates towards zero
+        np.trunc(values[:, 2]).astype(np.int64).tolist(),
+        values[:, 3].tolist(),
+        date_time.astype(object).tolist()
+    ))
+
+
+def read_plt_file(file_path: str, activity_id: int, max_trackpoints: int = MAX_TRACKPOINTS,
+                  verbose: bool = True, parser: str = 'python') -> Optional[Tuple[Dict, List[tuple]]]:
+    """
+    Read a .plt file once and return the activity bounds together with its trackpoints
+    as (activity_id, lat, lon, altitude, date_days, date_time) tuples.
+    Files with more than max_trackpoints (if not None) are rejected from a line count
+    before any parsing happens.
+    Returns None if the file is oversized, unreadable or has no valid trackpoints.
+    Skipped files and lines are only reported when verbose. The 'numpy' parser
+    gives the same trackpoints as the line by line 'python' one, see parse_trackpoints_numpy.
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read()
+    except Exception as e:
+        print(f"Error processing file {file_path}: {e}")
+        return None
+
+    line_count = count_trackpoint_lines(data)
+    if max_trackpoints is not None and line_count > max_trackpoints:
+        if verbose:
+            print(f"Skipping file {file_path} due to too many trackpoints ({line_count}).")
+        return None
+
+    try:
+        lines = data.decode().splitlines()[HEADER_LINES:]
+    except UnicodeDecodeError as e:
+        print(f"Error processing file {file_path}: {e}")
+        return None
+    trackpoints = None
+    if parser == 'numpy':
+        trackpoints = parse_trackpoints_numpy(lines, activity_id)
+    if trackpoints is None:
+        trackpoints = parse_trackpoints(lines, activity_id, file_path, verbose)
+
+    if not trackpoints:
+        return None
+
+    activity_data = {
+        'start_date_time': trackpoints[0][5],
+        'end_date_time': trackpoints[-1][5]
+    }
+    return activity_data, trackpoints
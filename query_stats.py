@@ -0,0 +1,89 @@
+import threading
+from typing import Dict, List, Tuple
+
+import bson
+from pymongo import monitoring
+
+# Commands whose replies carry documents back to the client
+CURSOR_COMMANDS = {'find', 'aggregate', 'getMore'}
+# Commands that can be re-run with explain to find the number of examined documents
+EXPLAINABLE_COMMANDS = {'find', 'aggregate', 'count', 'distinct'}
+
+
+class QueryStatsListener(monitoring.CommandListener):
+    """
+    Attributes the commands a thread sends to the query it is currently running,
+    and sums the documents and bytes returned per query. Register it with
+    pymongo.monitoring.register before the MongoClient is created.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def start_query(self, name: str):
+        self.local.query = name
+        with self.lock:
+            self.stats[name] = {"commands": 0, "docs_returned": 0, "bytes_returned": 0, "explainable": []}
+
+    def end_query(self) -> Dict:
+        name = getattr(self.local, 'query', None)
+        self.local.query = None
+        with self.lock:
+            return self.stats.pop(name, None)
+
+    def started(self, event):
+        name = getattr(self.local, 'query', None)
+        if name is None or event.command_name not in EXPLAINABLE_COMMANDS:
+            return
+        # Keep the command without session and driver fields so it can be explained later
+        command = {k: v for k, v in event.command.items() if not k.startswith('$') and k != 'lsid'}
+        with self.lock:
+            self.stats[name]["explainable"].append((event.database_name, command))
+
+    def succeeded(self, event):
+        name = getattr(self.local, 'query', None)
+        if name is None:
+            return
+        docs = 0
+        if event.command_name in CURSOR_COMMANDS:
+            cursor = event.reply.get('cursor', {})
+            docs = len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+        elif event.command_name == 'distinct':
+            docs = len(event.reply.get('values', []))
+        size = len(bson.encode(event.reply))
+        with self.lock:
+            stats = self.stats[name]
+            stats["commands"] += 1
+            stats["docs_returned"] += docs
+            stats["bytes_returned"] += size
+
+    def failed(self, event):
+        pass
+
+
+def sum_docs_examined(explain_output) -> int:
+    """
+    Add up every totalDocsExamined in an explain("executionStats") result. Aggregations
+    report it per stage, so the whole output is searched.
+    """
+    if isinstance(explain_output, dict):
+        return sum(
+            value if key == 'totalDocsExamined' and isinstance(value, int) else sum_docs_examined(value)
+            for key, value in explain_output.items()
+        )
+    if isinstance(explain_output, list):
+        return sum(sum_docs_examined(value) for value in explain_output)
+    return 0
+
+
+def explain_commands(client, explainable) -> List[Tuple[Dict, Dict]]:
+    """
+    Re-run the recorded commands with explain("executionStats") and return each
+    command together with its explain output.
+    """
+    return [
+        (command, client[database_name].command('explain', command, verbosity='executionStats'))
+        for database_name, command in explainable
+    ]
@@ -0,0 +1,109 @@
+import datetime
+import functools
+import hashlib
+import json
+from typing import Any, Dict, Tuple
+
+from pymongo import ASCENDING, ReturnDocument
+
+# Document in the metadata collection holding the data generation counter
+DATA_GENERATION_ID = "data_generation"
+
+
+def get_data_generation(db) -> int:
+    doc = db.metadata.find_one({"_id": DATA_GENERATION_ID})
+    return doc["value"] if doc else 0
+
+
+def bump_data_generation(db) -> int:
+    """
+    Mark the data as changed, which invalidates every cached report.
+    Called by the ingest code in main.py whenever it writes to the collections.
+    """
+    doc = db.metadata.find_one_and_update(
+        {"_id": DATA_GENERATION_ID},
+        {"$inc": {"value": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return doc["value"]
+
+
+class ReportCache:
+    """
+    Results of the part2 report queries, stored in the report_cache collection and
+    keyed by query name, parameters and the data generation. Once the collection
+    holds more than max_entries, the least recently used entries are evicted.
+    """
+
+    def __init__(self, db, max_entries: int = 256):
+        self.collection = db.report_cache
+        self.db = db
+        self.max_entries = max_entries
+        self.collection.create_index([("last_used", ASCENDING)])
+
+    @staticmethod
+    def make_key(name: str, params: Dict, generation: int) -> str:
+        raw = json.dumps([name, params, generation], sort_keys=True, default=str)
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def get(self, name: str, params: Dict, generation: int) -> Tuple[bool, Any]:
+        key = self.make_key(name, params, generation)
+        doc = self.collection.find_one_and_update(
+            {"_id": key},
+            {"$set": {"last_used": datetime.datetime.utcnow()}}
+        )
+        if doc is None:
+            return False, None
+        return True, doc["value"]
+
+    def put(self, name: str, params: Dict, generation: int, value: Any):
+        """
+        Store a result computed from the data of generation. It is dropped if the data
+        changed meanwhile, e.g. a report that ran during an ingest, as it may have read
+        partial data that must not be served under the new generation.
+        """
+        if get_data_generation(self.db) != generation:
+            return
+        now = datetime.datetime.utcnow()
+        self.collection.replace_one(
+            {"_id": self.make_key(name, params, generation)},
+            {"name": name, "generation": generation, "value": value, "created_at": now, "last_used": now},
+            upsert=True
+        )
+        # Entries of older generations can never be hit again
+        self.collection.delete_many({"generation": {"$ne": generation}})
+        self.evict()
+
+    def evict(self):
+        excess = self.collection.estimated_document_count() - self.max_entries
+        if excess > 0:
+            oldest = self.collection.find({}, {"_id": 1}).sort("last_used", ASCENDING).limit(excess)
+            self.collection.delete_many({"_id": {"$in": [doc["_id"] for doc in oldest]}})
+
+    def clear(self):
+        self.collection.delete_many({})
+
+
+def cached_report(func):
+    """
+    Cache the return value of a report method in self.report_cache, if it has one.
+    The value has to be storable in BSON (lists, dicts with string keys, numbers,
+    strings, datetimes) and should not contain tuples, so a cached result looks
+    the same as a freshly computed one.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        cache = getattr(self, 'report_cache', None)
+        if cache is None:
+            return func(self, *args, **kwargs)
+        params = {"args": list(args), "kwargs": kwargs}
+        # Read once, before the report runs, so the result is keyed by the data it saw
+        generation = get_data_generation(cache.db)
+        hit, value = cache.get(func.__name__, params, generation)
+        if hit:
+            return value
+        value = func(self, *args, **kwargs)
+        cache.put(func.__name__, params, generation, value)
+        return value
+    return wrapper
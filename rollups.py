@@ -0,0 +1,163 @@
+from typing import Dict, Iterable, List, Tuple
+
+from pymongo import UpdateOne
+
+# Activity, trackpoint and duration totals per user, per user and transportation mode
+# and per start year. main.py keeps them up to date on every write to activities, so
+# the aggregate reports in part2.py read a few hundred documents instead of all activities
+USER_ROLLUP = 'rollup_users'
+USER_MODE_ROLLUP = 'rollup_user_modes'
+YEAR_ROLLUP = 'rollup_years'
+ROLLUP_COLLECTIONS = [USER_ROLLUP, USER_MODE_ROLLUP, YEAR_ROLLUP]
+
+# Document in the metadata collection marking the rollups as matching activities
+ROLLUP_STATE_ID = "rollups"
+
+# The fields of an activity the rollups are computed from
+ROLLUP_FIELDS = {"user_id": 1, "transportation_mode": 1, "start_date_time": 1, "end_date_time": 1,
+                 "trackpoint_count": 1}
+
+
+# Sums activities, trackpoints and seconds per (user, mode, year), see rebuild_rollups
+REBUILD_PIPELINE = [
+    {"$project": {
+        "user_id": 1,
+        "transportation_mode": 1,
+        "year": {"$year": "$start_date_time"},
+        "seconds": {"$divide": [{"$subtract": ["$end_date_time", "$start_date_time"]}, 1000]},
+        "trackpoint_count": {"$ifNull": [
+            "$trackpoint_count",
+            "$trackpoint_columns.count",
+            {"$size": {"$ifNull": ["$trackpoints", []]}}
+        ]}
+    }},
+    {"$group": {
+        "_id": {"user_id": "$user_id", "transportation_mode": "$transportation_mode", "year": "$year"},
+        "activities": {"$sum": 1},
+        "trackpoints": {"$sum": "$trackpoint_count"},
+        "seconds": {"$sum": "$seconds"}
+    }}
+]
+
+
+def rollup_keys(activity: Dict) -> Dict[str, Tuple]:
+    """
+    The key of the document an activity counts towards in each rollup collection.
+    """
+    return {
+        USER_ROLLUP: (activity['user_id'],),
+        USER_MODE_ROLLUP: (activity['user_id'], activity.get('transportation_mode')),
+        YEAR_ROLLUP: (activity['start_date_time'].year,)
+    }
+
+
+def rollup_id(collection: str, key: Tuple):
+    if collection == USER_MODE_ROLLUP:
+        return {"user_id": key[0], "transportation_mode": key[1]}
+    return key[0]
+
+
+def rollup_deltas(activities: Iterable[Dict], sign: int = 1,
+                  collections: List[str] = ROLLUP_COLLECTIONS) -> Dict[str, Dict[Tuple, List]]:
+    """
+    Sum the [activities, trackpoints, seconds] of the activities per rollup document,
+    negated with sign=-1 for activities that are removed.
+    """
+    deltas = {collection: {} for collection in collections}
+    for activity in activities:
+        seconds = (activity['end_date_time'] - activity['start_date_time']).total_seconds()
+        values = (sign, sign * activity.get('trackpoint_count', 0), sign * seconds)
+        for collection, key in rollup_keys(activity).items():
+            if collection in deltas:
+                totals = deltas[collection].setdefault(key, [0, 0, 0.0])
+                for i, value in enumerate(values):
+                    totals[i] += value
+    return deltas
+
+
+def apply_rollup_deltas(db, deltas: Dict[str, Dict[Tuple, List]]):
+    """
+    Add the deltas to the rollup documents with $inc upserts, which are atomic, so
+    concurrent writers (pipeline threads, distributed workers) do not lose updates.
+    """
+    for collection, totals in deltas.items():
+        updates = [
+            UpdateOne(
+                {"_id": rollup_id(collection, key)},
+                {"$inc": {"activities": activities, "trackpoints": trackpoints, "seconds": seconds}},
+                upsert=True
+            )
+            for key, (activities, trackpoints, seconds) in totals.items()
+            if activities or trackpoints or seconds
+        ]
+        if updates:
+            db[collection].bulk_write(updates, ordered=False)
+
+
+def add_to_rollups(db, activities: Iterable[Dict], sign: int = 1):
+    apply_rollup_deltas(db, rollup_deltas(activities, sign))
+
+
+def move_mode_rollups(db, changes: List[Tuple[Dict, str]]):
+    """
+    Move activities from the user-mode rollup of their old transportation_mode to that
+    of the new one, given as (activity with its old mode, new mode) pairs.
+    """
+    removed = [activity for activity, _ in changes]
+    added = [{**activity, "transportation_mode": mode} for activity, mode in changes]
+    deltas = rollup_deltas(removed, -1, [USER_MODE_ROLLUP])
+    for key, values in rollup_deltas(added, 1, [USER_MODE_ROLLUP])[USER_MODE_ROLLUP].items():
+        totals = deltas[USER_MODE_ROLLUP].setdefault(key, [0, 0, 0.0])
+        for i, value in enumerate(values):
+            totals[i] += value
+    apply_rollup_deltas(db, deltas)
+
+
+def reset_rollups(db):
+    """
+    Empty the rollups for an empty activities collection.
+    """
+    for collection in ROLLUP_COLLECTIONS:
+        db[collection].drop()
+    set_rollups_ready(db, True)
+
+
+def rebuild_rollups(db) -> int:
+    """
+    Recompute the rollups from activities with one aggregation, e.g. for data ingested
+    before they existed. Run it while nothing else writes to activities. Returns the
+    number of (user, mode, year) groups.
+    """
+    set_rollups_ready(db, False)
+    groups = list(db.activities.aggregate(REBUILD_PIPELINE))
+
+    deltas = {collection: {} for collection in ROLLUP_COLLECTIONS}
+    for group in groups:
+        keys = {
+            USER_ROLLUP: (group['_id']['user_id'],),
+            USER_MODE_ROLLUP: (group['_id']['user_id'], group['_id'].get('transportation_mode')),
+            YEAR_ROLLUP: (group['_id']['year'],)
+        }
+        for collection, key in keys.items():
+            totals = deltas[collection].setdefault(key, [0, 0, 0.0])
+            totals[0] += group['activities']
+            totals[1] += group['trackpoints']
+            totals[2] += group['seconds']
+
+    for collection in ROLLUP_COLLECTIONS:
+        db[collection].drop()
+    apply_rollup_deltas(db, deltas)
+    set_rollups_ready(db, True)
+    return len(groups)
+
+
+def set_rollups_ready(db, ready: bool):
+    db.metadata.update_one({"_id": ROLLUP_STATE_ID}, {"$set": {"ready": ready}}, upsert=True)
+
+
+def rollups_ready(db) -> bool:
+    """
+    Whether the rollups were built for the current data, either by a full ingest
+    or by rebuild_rollups. Data ingested before they existed has no rollups.
+    """
+    return db.metadata.count_documents({"_id": ROLLUP_STATE_ID, "ready": True}) > 0
@@ -0,0 +1,129 @@
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from pymongo import UpdateOne
+
+from trackpoint_codec import TRACKPOINT_FIELDS, activity_columns, decode_trackpoints, encode_trackpoints
+from trajectory_stats import activity_geometry
+
+# Trackpoints per document in the trackpoint_buckets collection
+BUCKET_SIZE = 1000
+
+
+def bucket_id(activity_id: int, seq: int) -> str:
+    return f"{activity_id}:{seq}"
+
+
+def build_buckets(activity_id: int, user_id: str, trackpoints: List[tuple],
+                  bucket_size: int = BUCKET_SIZE) -> List[Dict]:
+    """
+    Split the (activity_id, lat, lon, altitude, date_days, date_time) tuples of an
+    activity into trackpoint_buckets documents of at most bucket_size trackpoints,
+    each holding its part as packed columns (see trackpoint_codec.encode_columns)
+    together with its time range and a GeoJSON geometry covering its part of the path
+    (see trajectory_stats.activity_geometry), for the 2dsphere index. seq numbers the buckets of an activity from 0.
+    """
+    buckets = []
+    for seq, start in enumerate(range(0, len(trackpoints), bucket_size)):
+        part = trackpoints[start:start + bucket_size]
+        bucket = {
+            "_id": bucket_id(activity_id, seq),
+            "activity_id": activity_id,
+            "seq": seq,
+            "user_id": user_id,
+            "start_date_time": part[0][5],
+            "end_date_time": part[-1][5],
+            "count": len(part),
+            "columns": encode_trackpoints(part)
+        }
+        geometry = activity_geometry([point[1] for point in part], [point[2] for point in part])
+        if geometry:
+            bucket["geometry"] = geometry
+        buckets.append(bucket)
+    return buckets
+
+
+def bucket_count(trackpoint_count: int, bucket_size: int = BUCKET_SIZE) -> int:
+    return -(-trackpoint_count // bucket_size)
+
+
+def backfill_bucket_geometry(collection, only_missing: bool = True, batch_size: int = 100) -> int:
+    """
+    Store the geometry of buckets written without one or with a full LineString path
+    (or of all buckets if only_missing is False). Returns the number of buckets updated.
+    """
+    query = {}
+    if only_missing:
+        query = {"$or": [{"geometry": {"$exists": False}}, {"geometry.type": "LineString"}]}
+    projection = {"columns.lat": 1, "columns.lon": 1}
+    updates = []
+    updated = 0
+    for bucket in collection.find(query, projection, batch_size=batch_size):
+        columns = decode_trackpoints(bucket["columns"], ['lat', 'lon'])
+        geometry = activity_geometry(columns['lat'], columns['lon'])
+        if geometry:
+            updates.append(UpdateOne({"_id": bucket["_id"]}, {"$set": {"geometry": geometry}}))
+        if len(updates) >= batch_size:
+            updated += collection.bulk_write(updates, ordered=False).modified_count
+            updates = []
+    if updates:
+        updated += collection.bulk_write(updates, ordered=False).modified_count
+    return updated
+
+
+def read_bucket_columns(collection, activity_ids: List[int], fields: List[str] = None,
+                        max_seq: int = None) -> Dict[int, Dict[str, np.ndarray]]:
+    """
+    The requested trackpoint columns of the given bucketed activities, fetched with
+    one query and concatenated in seq order per activity. With max_seq only the
+    buckets up to that one are read.
+    """
+    fields = fields or TRACKPOINT_FIELDS
+    projection = {"activity_id": 1, "seq": 1, **{f"columns.{field}": 1 for field in fields}}
+    if 'date_time' in fields:
+        projection["columns.start"] = 1
+
+    query = {"activity_id": {"$in": activity_ids}}
+    if max_seq is not None:
+        query["seq"] = {"$lte": max_seq}
+    parts = {}
+    cursor = collection.find(query, projection).sort(
+        [("activity_id", 1), ("seq", 1)]
+    )
+    for bucket in cursor:
+        parts.setdefault(bucket["activity_id"], []).append(decode_trackpoints(bucket["columns"], fields))
+    return {
+        activity_id: {field: np.concatenate([part[field] for part in activity_parts]) for field in fields}
+        for activity_id, activity_parts in parts.items()
+    }
+
+
+def with_activity_columns(collection, activities: Iterable[Dict], fields: List[str] = None,
+                          chunk_size: int = 100) -> Iterator[Tuple[Dict, Dict[str, np.ndarray]]]:
+    """
+    Yields (activity, columns) for every activity document, whichever format its
+    trackpoints are stored in. The buckets of bucketed activities (those with a
+    bucket_count) are read from collection chunk_size activities at a time.
+    """
+    chunk = []
+    for activity in activities:
+        chunk.append(activity)
+        if len(chunk) >= chunk_size:
+            yield from _chunk_columns(collection, chunk, fields)
+            chunk = []
+    if chunk:
+        yield from _chunk_columns(collection, chunk, fields)
+
+
+def _chunk_columns(collection, chunk: List[Dict], fields: List[str]):
+    bucketed_ids = [activity["_id"] for activity in chunk if "bucket_count" in activity]
+    bucketed = read_bucket_columns(collection, bucketed_ids, fields) if bucketed_ids else {}
+    for activity in chunk:
+        if "bucket_count" in activity:
+            columns = bucketed.get(activity["_id"])
+            if columns is None:
+                columns = activity_columns({}, fields)
+            yield activity, columns
+        else:
+            yield activity, activity_columns(activity, fields)
@@ -0,0 +1,107 @@
+from typing import Dict, List
+
+import numpy as np
+from bson.binary import Binary
+
+TRACKPOINT_FIELDS = ['lat', 'lon', 'altitude', 'date_days', 'date_time']
+
+# Little-endian dtypes of the packed columns
+COLUMN_DTYPES = {
+    'lat': '<f8',
+    'lon': '<f8',
+    'altitude': '<i4',
+    'date_days': '<f8',
+    # Seconds since the previous trackpoint, the first one relative to 'start'
+    'date_time': '<i4'
+}
+
+
+def trackpoints_to_columns(trackpoints: List[tuple]) -> Dict[str, np.ndarray]:
+    """
+    Turn (activity_id, lat, lon, altitude, date_days, date_time) tuples into NumPy
+    columns, in the same layout decode_trackpoints returns.
+    """
+    return {
+        'lat': np.array([tp[1] for tp in trackpoints], dtype=COLUMN_DTYPES['lat']),
+        'lon': np.array([tp[2] for tp in trackpoints], dtype=COLUMN_DTYPES['lon']),
+        'altitude': np.array([tp[3] for tp in trackpoints], dtype=COLUMN_DTYPES['altitude']),
+        'date_days': np.array([tp[4] for tp in trackpoints], dtype=COLUMN_DTYPES['date_days']),
+        'date_time': np.array([tp[5] for tp in trackpoints], dtype='datetime64[s]')
+    }
+
+
+def encode_columns(columns: Dict[str, np.ndarray]) -> Dict:
+    """
+    Pack NumPy trackpoint columns into one binary column per field. This is what
+    gets stored as 'trackpoint_columns' on an activity document in the columnar format.
+    """
+    date_time = columns['date_time']
+    start = date_time[0].item() if len(date_time) else None
+    encoded = {'count': len(date_time), 'start': start}
+    for field in TRACKPOINT_FIELDS:
+        column = columns[field]
+        if field == 'date_time':
+            column = np.diff(column.astype(np.int64), prepend=column[:1].astype(np.int64))
+        encoded[field] = Binary(column.astype(COLUMN_DTYPES[field]).tobytes())
+    return encoded
+
+
+def encode_trackpoints(trackpoints: List[tuple]) -> Dict:
+    """
+    Pack (activity_id, lat, lon, altitude, date_days, date_time) tuples, see encode_columns.
+    """
+    return encode_columns(trackpoints_to_columns(trackpoints))
+
+
+def decode_trackpoints(encoded: Dict, fields: List[str] = None) -> Dict[str, np.ndarray]:
+    """
+    Decode 'trackpoint_columns' into NumPy arrays. Timestamps are returned as
+    datetime64[s]. Only the requested fields are decoded, and only those need
+    to be present in the (possibly projected) document.
+    """
+    columns = {}
+    for field in fields or TRACKPOINT_FIELDS:
+        column = np.frombuffer(encoded[field], dtype=COLUMN_DTYPES[field])
+        if field == 'date_time':
+            start = np.datetime64(encoded['start'], 's')
+            column = start + np.cumsum(column, dtype=np.int64).astype('timedelta64[s]')
+        columns[field] = column
+    return columns
+
+
+def trackpoint_docs_to_columns(trackpoints: List[Dict], fields: List[str] = None) -> Dict[str, np.ndarray]:
+    """
+    Convert the embedded array format into the same NumPy columns as decode_trackpoints.
+    """
+    columns = {}
+    for field in fields or TRACKPOINT_FIELDS:
+        values = [tp[field] for tp in trackpoints]
+        if field == 'date_time':
+            columns[field] = np.array(values, dtype='datetime64[s]')
+        else:
+            columns[field] = np.array(values, dtype=COLUMN_DTYPES[field])
+    return columns
+
+
+def activity_columns(activity: Dict, fields: List[str] = None) -> Dict[str, np.ndarray]:
+    """
+    Return the trackpoints of an activity document as NumPy columns, whichever
+    format it is stored in.
+    """
+    if 'trackpoint_columns' in activity:
+        return decode_trackpoints(activity['trackpoint_columns'], fields)
+    return trackpoint_docs_to_columns(activity.get('trackpoints', []), fields)
+
+
+def columns_to_trackpoint_docs(columns: Dict[str, np.ndarray], limit: int = None) -> List[Dict]:
+    """
+    Turn decoded columns back into per-point documents, e.g. for printing.
+    """
+    count = len(next(iter(columns.values()))) if columns else 0
+    if limit is not None:
+        count = min(count, limit)
+    docs = []
+    for i in range(count):
+        # item() turns datetime64[s] into datetime.datetime as well
+        docs.append({field: column[i].item() for field, column in columns.items()})
+    return docs
@@ -0,0 +1,162 @@
+import argparse
+import datetime
+import json
+import os
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from report_cache import get_data_generation
+from trackpoint_codec import TRACKPOINT_FIELDS
+
+EXPORT_VERSION = 1
+# Dtypes of the exported column files, timestamps as datetime64[s] like decode_trackpoints returns
+EXPORT_DTYPES = {
+    'lat': '<f8',
+    'lon': '<f8',
+    'altitude': '<i4',
+    'date_days': '<f8',
+    'date_time': '<M8[s]'
+}
+
+
+def export_dataset(program, output_path: str, batch_size: int = 500) -> Dict:
+    """
+    Write the users and activities of a part2.ActivityTrackerProgram's database to
+    output_path: one contiguous <field>.bin file per trackpoint column, activities.npy
+    with the user, mode, time range and trackpoint offset and count of every activity
+    (sorted by _id), users.npy and meta.json. Trackpoints are streamed to the column
+    files one activity at a time, and meta.json is written last, so an interrupted
+    export is never opened by TrackpointStore.
+    """
+    os.makedirs(output_path, exist_ok=True)
+    meta_path = os.path.join(output_path, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    generation = get_data_generation(program.db)
+    rows = []
+    offset = 0
+    files = {field: open(os.path.join(output_path, f"{field}.bin"), 'wb') for field in TRACKPOINT_FIELDS}
+    try:
+        activities = program.iter_activity_columns(
+            {}, TRACKPOINT_FIELDS,
+            {"transportation_mode": 1, "start_date_time": 1, "end_date_time": 1},
+            batch_size, sort=[("_id", 1)]
+        )
+        for activity, columns in activities:
+            count = len(columns['date_time'])
+            for field, f in files.items():
+                f.write(np.ascontiguousarray(columns[field], dtype=EXPORT_DTYPES[field]).tobytes())
+            rows.append((activity['_id'], activity['user_id'], activity.get('transportation_mode') or '',
+                         activity['start_date_time'], activity['end_date_time'], offset, count))
+            offset += count
+    finally:
+        for f in files.values():
+            f.close()
+
+    users = [(doc['_id'], doc.get('has_labels', False)) for doc in program.db.users.find().sort('_id', 1)]
+    user_width = max([len(user_id) for user_id, _ in users] + [len(row[1]) for row in rows] + [1])
+    mode_width = max([len(row[2]) for row in rows] + [1])
+    np.save(os.path.join(output_path, 'activities.npy'), np.array(rows, dtype=[
+        ('activity_id', '<i8'),
+        ('user_id', f'<U{user_width}'),
+        ('transportation_mode', f'<U{mode_width}'),
+        ('start_date_time', '<M8[s]'),
+        ('end_date_time', '<M8[s]'),
+        ('offset', '<i8'),
+        ('count', '<i8')
+    ]))
+    np.save(os.path.join(output_path, 'users.npy'), np.array(users, dtype=[
+        ('user_id', f'<U{user_width}'),
+        ('has_labels', '?')
+    ]))
+
+    meta = {
+        "version": EXPORT_VERSION,
+        "exported_at": datetime.datetime.utcnow().isoformat(),
+        "data_generation": generation,
+        "users": len(users),
+        "activities": len(rows),
+        "trackpoints": offset,
+        "dtypes": EXPORT_DTYPES
+    }
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+class TrackpointStore:
+    """
+    Read-only view of an export_dataset directory. The column files and the activity
+    index are memory-mapped, so columns and activity_columns return zero-copy NumPy
+    views served from the page cache, in the same layout as trackpoint_codec.
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != EXPORT_VERSION:
+            raise ValueError(f"Unsupported export version {self.meta['version']} in {path}")
+        self.activities = np.load(os.path.join(path, 'activities.npy'), mmap_mode='r')
+        self.users = np.load(os.path.join(path, 'users.npy'), mmap_mode='r')
+        self.columns = {}
+        for field, dtype in self.meta["dtypes"].items():
+            if self.meta["trackpoints"]:
+                self.columns[field] = np.memmap(os.path.join(path, f"{field}.bin"), dtype=dtype, mode='r',
+                                                shape=(self.meta["trackpoints"],))
+            else:
+                # An empty file cannot be memory-mapped
+                self.columns[field] = np.empty(0, dtype=dtype)
+
+    def __len__(self) -> int:
+        return len(self.activities)
+
+    def select(self, user_id: str = None, transportation_mode: str = None,
+               start: datetime.datetime = None, end: datetime.datetime = None) -> np.ndarray:
+        """
+        Indices of the activities matching all given filters. Like
+        part2's build_activity_filter, start and end bound start_date_time.
+        """
+        mask = np.ones(len(self.activities), dtype=bool)
+        if user_id is not None:
+            mask &= self.activities['user_id'] == user_id
+        if transportation_mode is not None:
+            mask &= self.activities['transportation_mode'] == transportation_mode
+        if start is not None:
+            mask &= self.activities['start_date_time'] >= np.datetime64(start, 's')
+        if end is not None:
+            mask &= self.activities['start_date_time'] < np.datetime64(end, 's')
+        return np.flatnonzero(mask)
+
+    def activity_columns(self, index: int, fields: List[str] = None) -> Dict[str, np.ndarray]:
+        offset, count = int(self.activities['offset'][index]), int(self.activities['count'][index])
+        return {field: self.columns[field][offset:offset + count] for field in fields or TRACKPOINT_FIELDS}
+
+    def iter_activity_columns(self, indices=None, fields: List[str] = None) -> Iterator[Tuple[np.void, Dict]]:
+        """
+        Yields (activity row, columns) for the given activity indices, all by default.
+        """
+        for index in range(len(self.activities)) if indices is None else indices:
+            yield self.activities[index], self.activity_columns(index, fields)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export users and activities to memory-mappable column files")
+    parser.add_argument('output', help="directory to write the export to")
+    parser.add_argument('--batch-size', type=int, default=500, help="activities per cursor batch")
+    args = parser.parse_args()
+
+    from part2 import ActivityTrackerProgram
+
+    program = ActivityTrackerProgram(use_cache=False)
+    try:
+        meta = export_dataset(program, args.output, args.batch_size)
+        print(f"Exported {meta['users']} users, {meta['activities']} activities and "
+              f"{meta['trackpoints']} trackpoints to {args.output}")
+    finally:
+        program.connection.close_connection()
+
+
+if __name__ == '__main__':
+    main()
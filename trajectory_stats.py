@@ -0,0 +1,116 @@
+import numpy as np
+
+# Mean earth radius, the same value the haversine package uses
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """
+    Great-circle distance in km between each pair of consecutive points,
+    computed over the whole trajectory at once.
+    """
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    d_lat = np.diff(lat)
+    d_lon = np.diff(lon)
+    a = np.sin(d_lat / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(d_lon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def path_length_km(lat: np.ndarray, lon: np.ndarray) -> float:
+    """
+    Total length in km of the trajectory through the given points.
+    """
+    if len(lat) < 2:
+        return 0.0
+    return float(haversine_km(lat, lon).sum())
+
+
+def altitude_gain(altitude: np.ndarray, invalid_altitude: int = -777) -> int:
+    """
+    Sum of the positive altitude differences between consecutive points, in the
+    unit of the input (feet in Geolife). Points with the invalid altitude are left out.
+    """
+    altitude = np.asarray(altitude, dtype=np.int64)
+    gains = np.diff(altitude[altitude != invalid_altitude])
+    return int(gains[gains > 0].sum())
+
+
+def max_gap_seconds(date_time: np.ndarray) -> int:
+    """
+    Largest time difference in seconds between two consecutive points.
+    """
+    if len(date_time) < 2:
+        return 0
+    return int(np.diff(np.asarray(date_time, dtype='datetime64[s]')).astype(np.int64).max())
+
+
+def compute_activity_stats(columns: dict) -> dict:
+    """
+    Per-activity facts that the reports need, computed from the lat, lon, altitude
+    and date_time columns of its trackpoints. They are stored as top-level fields
+    on the activity document.
+    """
+    date_time = np.asarray(columns['date_time'], dtype='datetime64[s]')
+    duration = int((date_time[-1] - date_time[0]).astype(np.int64)) if len(date_time) else 0
+    return {
+        "trackpoint_count": len(date_time),
+        "distance_km": path_length_km(columns['lat'], columns['lon']),
+        "altitude_gain_ft": altitude_gain(columns['altitude']),
+        "max_gap_seconds": max_gap_seconds(date_time),
+        "duration_seconds": duration
+    }
+
+
+def distance_to_point_m(lat: np.ndarray, lon: np.ndarray, center_lat: float, center_lon: float) -> np.ndarray:
+    """
+    Great-circle distance in meters from every point to one center point.
+    """
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    center_lat, center_lon = np.radians(center_lat), np.radians(center_lon)
+    a = (np.sin((lat - center_lat) / 2) ** 2
+         + np.cos(lat) * np.cos(center_lat) * np.sin((lon - center_lon) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * 1000 * np.arcsin(np.sqrt(a))
+
+
+def activity_geometry(lat: np.ndarray, lon: np.ndarray):
+    """
+    GeoJSON cover of the trackpoints of an activity for a 2dsphere index: a Point if
+    there is one distinct position, otherwise the Polygon of their bounding box, so the
+    stored geometry has a fixed size however long the path is. The reports only use it
+    to find candidates and check the trackpoints exactly afterwards. The polygon edges
+    are geodesics, which bend poleward between the corners, so the edge facing the
+    equator is moved out far enough to still contain every point. Boxes spanning 180 degrees of longitude or more
+    cannot be drawn that way and fall back to the path as a LineString. Out of range
+    coordinates are left out, since MongoDB rejects those. Returns None if nothing is left.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    valid = (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+    lat, lon = lat[valid], lon[valid]
+    if len(lat) == 0:
+        return None
+    if (lat == lat[0]).all() and (lon == lon[0]).all():
+        return {"type": "Point", "coordinates": [float(lon[0]), float(lat[0])]}
+
+    min_lon, max_lon = float(lon.min()), float(lon.max())
+    if max_lon - min_lon >= 180:
+        # Consecutive duplicate points are left out, as MongoDB rejects those
+        changed = np.ones(len(lat), dtype=bool)
+        changed[1:] = (np.diff(lat) != 0) | (np.diff(lon) != 0)
+        return {"type": "LineString", "coordinates": np.column_stack((lon[changed], lat[changed])).tolist()}
+
+    pad = 1e-6
+    min_lon, max_lon = max(min_lon - pad, -180.0), min(max_lon + pad, 180.0)
+    min_lat, max_lat = max(float(lat.min()) - pad, -90.0), min(float(lat.max()) + pad, 90.0)
+    # A geodesic between corners at latitude phi peaks at atan(tan(phi) / cos(span / 2)), so
+    # the edge facing the equator is moved to where its peak is the lowest latitude to cover
+    shrink = np.cos(np.radians(max_lon - min_lon) / 2)
+    if min_lat > 0:
+        min_lat = float(np.degrees(np.arctan(shrink * np.tan(np.radians(min_lat)))))
+    if max_lat < 0:
+        max_lat = float(np.degrees(np.arctan(shrink * np.tan(np.radians(max_lat)))))
+    return {"type": "Polygon", "coordinates": [[
+        [min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat], [min_lon, max_lat], [min_lon, min_lat]
+    ]]}